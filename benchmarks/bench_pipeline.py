@@ -0,0 +1,227 @@
+"""Offline throughput benchmarks of the pipeline's own overhead (no GPU, no network).
+
+Synthetic ontologies, annotation indexes and candidate tables of the requested sizes are generated,
+and a deterministic stub `LMPredictor` stands in for the model. Pairs/sec and peak Python memory are
+reported per benchmark and compared against `baselines.json`; a drop in throughput (or a growth in
+memory) beyond the tolerance fails the run. Benchmarks without a baseline are reported with a warning.
+
+Baselines are machine-specific, so none are shipped. Record them once on the reference machine (the
+description of the machine is stored along) and keep `baselines.json` with it:
+
+    python benchmarks/bench_pipeline.py --update_baselines
+    python benchmarks/bench_pipeline.py --pairs 1000 --pairs 100000
+"""
+
+import os
+import sys
+
+main_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(main_dir)
+
+import gc
+import json
+import platform
+import random
+import tempfile
+import time
+import tracemalloc
+import click
+from llmap_prelim import run_experiments
+from llmap_prelim.models import LMPredictor
+from llmap_prelim.snapshot import OntologySnapshot
+from llmap_prelim.processing import truncate_labels, integrated_template, get_parent_labels, get_child_labels
+from llmap_prelim.eval import unpack_results_for_llm, unpack_results_for_bertmap, unpack_result_store, evaluate
+from llmap_prelim.store import ResultStore
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines.json")
+CANDS_PER_SRC = 100
+VOCAB = [f"w{i}" for i in range(2000)]
+
+
+def synthetic_annotation_index(prefix: str, num_classes: int, rng: random.Random):
+    return {
+        f"http://example.org/{prefix}#C{i}": {" ".join(rng.choices(VOCAB, k=rng.randint(1, 6))) for _ in range(3)}
+        for i in range(num_classes)
+    }
+
+
+def synthetic_snapshot(annotation_index: dict, snapshot_dir: str, rng: random.Random):
+    # a random forest: every class but the first has up to two earlier classes as parents
+    iris = list(annotation_index.keys())
+    parent_iris = {iri: [iris[rng.randrange(i)] for _ in range(rng.randint(1, 2) if i else 0)] for i, iri in enumerate(iris)}
+    return OntologySnapshot.write(snapshot_dir, annotation_index, parent_iris, owl_hash="synthetic")
+
+
+def synthetic_setting(num_pairs: int, work_dir: str, seed: int = 0):
+    rng = random.Random(seed)
+    num_src = max(1, num_pairs // CANDS_PER_SRC)
+    src_annotation_index = synthetic_annotation_index("src", num_src, rng)
+    tgt_annotation_index = synthetic_annotation_index("tgt", max(CANDS_PER_SRC, num_src), rng)
+    src_onto = synthetic_snapshot(src_annotation_index, os.path.join(work_dir, "src.snapshot"), rng)
+    tgt_onto = synthetic_snapshot(tgt_annotation_index, os.path.join(work_dir, "tgt.snapshot"), rng)
+    tgt_iris = list(tgt_annotation_index.keys())
+    test_cands = []
+    for i, src_class_iri in enumerate(src_annotation_index.keys()):
+        tgt_cands = rng.sample(tgt_iris, CANDS_PER_SRC)
+        # half of the source classes are matched (to the first candidate), as in the real test sets
+        test_cands.append((src_class_iri, tgt_cands[0] if i % 2 == 0 else "UnMatched", tgt_cands))
+    return src_onto, tgt_onto, src_annotation_index, tgt_annotation_index, test_cands
+
+
+def measure(fn, num_pairs: int, with_memory: bool):
+    """Run `fn` once timed and (optionally) once more under `tracemalloc` for the peak memory."""
+    gc.collect()
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+    peak_mb = None
+    if with_memory:
+        gc.collect()
+        tracemalloc.start()
+        fn()
+        peak_mb = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.stop()
+    return {"pairs_per_second": num_pairs / elapsed, "seconds": elapsed, "peak_memory_mb": peak_mb}
+
+
+def run_benchmarks(num_pairs: int, latency: float, with_structural_context: bool, with_memory: bool):
+    results = dict()
+    with tempfile.TemporaryDirectory() as work_dir:
+        src_onto, tgt_onto, src_annotation_index, tgt_annotation_index, test_cands = synthetic_setting(
+            num_pairs, work_dir
+        )
+        num_pairs = sum(len(tgt_cands) for _, _, tgt_cands in test_cands)
+        pairs = [(src, cand) for src, _, tgt_cands in test_cands for cand in tgt_cands]
+
+        def build_prompts():
+            for src, cand in pairs:
+                integrated_template(
+                    truncate_labels(src_annotation_index[src], 3), truncate_labels(tgt_annotation_index[cand], 3)
+                )
+
+        def structural_context():
+            for _, cand in pairs:
+                get_parent_labels(tgt_onto, tgt_annotation_index, cand)
+                get_child_labels(tgt_onto, tgt_annotation_index, cand)
+
+        result_file = os.path.join(work_dir, "results.pkl")
+
+        def pipeline():
+            if os.path.exists(result_file):
+                os.remove(result_file)
+            predictor = LMPredictor("stub", stub_latency=latency)
+            run_experiments(
+                src_onto,
+                tgt_onto,
+                src_annotation_index,
+                tgt_annotation_index,
+                predictor,
+                test_cands,
+                result_file,
+                with_structural_context=with_structural_context,
+            )
+
+        results["integrated_template"] = measure(build_prompts, num_pairs, with_memory)
+        results["structural_context"] = measure(structural_context, num_pairs, with_memory)
+        results["run_experiments"] = measure(pipeline, num_pairs, with_memory)
+
+        from deeponto.utils import load_file
+        from deeponto.align.mapping import ReferenceMapping
+
+        result_dict = load_file(result_file)
+        refs = [ReferenceMapping(src, ref, "=") for src, ref, _ in test_cands if ref != "UnMatched"]
+
+        def evaluation():
+            final_preds, ranked_preds = unpack_results_for_llm(result_dict)
+            evaluate(final_preds, ranked_preds, refs)
+
+        results["unpack_and_evaluate"] = measure(evaluation, num_pairs, with_memory)
+
+        store = ResultStore.from_results(result_dict)
+
+        def store_evaluation():
+            final_preds, ranked_preds = unpack_result_store(store)
+            evaluate(final_preds, ranked_preds, refs)
+
+        results["store_unpack_and_evaluate"] = measure(store_evaluation, num_pairs, with_memory)
+
+        # BERTMap results hold a (BERTMap, BERTMapLt) score pair instead of an answer
+        rng = random.Random(0)
+        bertmap_result_dict = {k: {cand: (rng.random(), rng.random()) for cand in v} for k, v in result_dict.items()}
+
+        def bertmap_evaluation():
+            bertmap_final_preds, bertmap_ranked_preds, bertmaplt_final_preds, bertmaplt_ranked_preds = (
+                unpack_results_for_bertmap(bertmap_result_dict)
+            )
+            evaluate(bertmap_final_preds, bertmap_ranked_preds, refs)
+            evaluate(bertmaplt_final_preds, bertmaplt_ranked_preds, refs)
+
+        results["bertmap_unpack_and_evaluate"] = measure(bertmap_evaluation, num_pairs, with_memory)
+
+    return results
+
+
+def check_regressions(results: dict, baselines: dict, tolerance: float):
+    """Regressions against the baselines, and the benchmarks that have no baseline."""
+    failures, missing = [], []
+    for name, result in results.items():
+        baseline = baselines.get(name)
+        if baseline is None:
+            missing.append(name)
+            continue
+        throughput, baseline_throughput = result["pairs_per_second"], baseline["pairs_per_second"]
+        if throughput < baseline_throughput * (1 - tolerance):
+            failures.append(f"{name}: {throughput:.0f} pairs/sec vs. baseline {baseline_throughput:.0f}")
+        memory, baseline_memory = result["peak_memory_mb"], baseline.get("peak_memory_mb")
+        if memory and baseline_memory and memory > baseline_memory * (1 + tolerance):
+            failures.append(f"{name}: {memory:.1f} MB peak vs. baseline {baseline_memory:.1f} MB")
+    return failures, missing
+
+
+def machine_info():
+    return {"platform": platform.platform(), "processor": platform.processor(), "python": platform.python_version()}
+
+
+@click.command()
+@click.option("-p", "--pairs", "pair_sizes", type=int, multiple=True, default=[1000, 10000])
+@click.option("-l", "--latency", type=float, default=0.0, help="fixed stub latency per model call (seconds)")
+@click.option("-s", "--with_structural_context", type=bool, default=False)
+@click.option("--memory/--no_memory", default=True)
+@click.option("--tolerance", type=float, default=0.2)
+@click.option("--update_baselines", is_flag=True, default=False)
+def run(pair_sizes, latency, with_structural_context, memory, tolerance, update_baselines):
+
+    baselines = dict()
+    if os.path.exists(BASELINE_FILE):
+        with open(BASELINE_FILE, "r") as f:
+            baselines = json.load(f)
+    reference_machine = baselines.get("reference_machine")
+    if reference_machine and reference_machine != machine_info() and not update_baselines:
+        print(f"Warning: the baselines were recorded on a different machine: {reference_machine}")
+
+    failures = []
+    for num_pairs in pair_sizes:
+        results = run_benchmarks(num_pairs, latency, with_structural_context, memory)
+        key = f"pairs={num_pairs},latency={latency},structural={with_structural_context}"
+        for name, result in results.items():
+            memory_info = f", {result['peak_memory_mb']:.1f} MB peak" if result["peak_memory_mb"] else ""
+            print(f"[{key}] {name}: {result['pairs_per_second']:.0f} pairs/sec{memory_info}")
+        if update_baselines:
+            baselines[key] = results
+        else:
+            regressions, missing = check_regressions(results, baselines.get(key, dict()), tolerance)
+            failures += [f"[{key}] {f}" for f in regressions]
+            if missing:
+                print(f"Warning: [{key}] no baseline for {', '.join(missing)}; record one with --update_baselines")
+
+    if update_baselines:
+        baselines["reference_machine"] = machine_info()
+        with open(BASELINE_FILE, "w") as f:
+            json.dump(baselines, f, indent=4)
+    if failures:
+        print("Performance regressions:\n" + "\n".join(failures))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    run()
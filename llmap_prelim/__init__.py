@@ -11,84 +11,301 @@
 #    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 #    See the License for the specific language governing permissions and
 #   limitations under the License.
-from deeponto.onto import Ontology
-from deeponto.utils import load_file, save_file
+from typing import Optional, Union, Iterable, TYPE_CHECKING
 from collections import defaultdict
+import functools
 import enlighten
 from pandas import DataFrame
-from .models import LMPredictor
-from .processing import truncate_labels, integrated_template, get_parent_labels, get_child_labels
+from .models import LMPredictor, EscalatingPredictor
+from .processing import (
+    truncate_labels,
+    integrated_template,
+    budgeted_template,
+    listwise_template,
+    listwise_chunks,
+    listwise_result,
+    parse_listwise_answer,
+    get_context_labels,
+)
+from .journal import ResultJournal, journal_file_of, load_results, compact_results
+from .snapshot import OntologySnapshot
+from .candidates import iter_candidates
+from .metrics import RunMetrics, Stopwatch
+from .cascade import rank_candidates_lexically, split_candidates, pruned_result, edit_similarity_scores
+from .pipeline import prefetch, BackgroundWriter
+
+if TYPE_CHECKING:
+    from deeponto.onto import Ontology
 
 
 def run_experiments(
-    src_onto: Ontology,
-    tgt_onto: Ontology,
+    src_onto: Union["Ontology", OntologySnapshot],
+    tgt_onto: Union["Ontology", OntologySnapshot],
     src_annotation_index: dict,
     tgt_annotation_index: dict,
-    predictor: LMPredictor,
-    test_cands: DataFrame,
+    predictor: Union[LMPredictor, EscalatingPredictor],
+    test_cands: Union[DataFrame, str, Iterable],
     result_file: str,
     with_structural_context: bool = False,
+    batch_size: int = 16,
+    src_hierarchy_index: Optional[dict] = None,
+    tgt_hierarchy_index: Optional[dict] = None,
+    cascade_top_k: Optional[int] = None,
+    cascade_threshold: Optional[float] = None,
+    listwise: bool = False,
+    listwise_chunk_size: int = 20,
+    metrics_file: Optional[str] = None,
+    prompt_token_budget: Optional[int] = None,
+    pipeline_prefetch: int = 0,
 ):
 
-    try:
-        result_dict = load_file(result_file)
-    except:
-        result_dict = defaultdict(dict)
+    if listwise and predictor.model_type != "bertmap" and not hasattr(predictor, "complete"):
+        # e.g., `EscalatingPredictor` only scores (source, candidate) pairs
+        raise ValueError(
+            f"listwise prompting needs a predictor with `complete`, unlike the {predictor.model_type} predictor"
+        )
+
+    # structural context is looked up in the (precomputed) hierarchy indexes and memoised on a miss
+    src_hierarchy_index = src_hierarchy_index if src_hierarchy_index is not None else dict()
+    tgt_hierarchy_index = tgt_hierarchy_index if tgt_hierarchy_index is not None else dict()
+
+    # scored candidates are appended to a journal and compacted into `result_file` at the end
+    result_dict = load_results(result_file)
+    journal = ResultJournal(journal_file_of(result_file))
+
+    # per-pair stage timings (and prompt token counts if a metrics file is given)
+    metrics = RunMetrics(metrics_file)
+    # labels recur across prompts, so their token counts are memoised
+    count_tokens = functools.lru_cache(maxsize=1 << 16)(predictor.count_tokens)
 
     enlighten_manager = enlighten.get_manager()
-    progress_bar = enlighten_manager.counter(total=len(test_cands), desc="Mapping Prediction", unit="per src class")
+    # candidates are streamed so that prediction starts before a large candidate file is fully read
+    progress_bar = enlighten_manager.counter(
+        total=len(test_cands) if isinstance(test_cands, DataFrame) else None,
+        desc="Mapping Prediction",
+        unit="per src class",
+    )
 
-    for _, dp in test_cands.iterrows():
+    # with pipelining, prompts are prepared ahead in a background thread and journal/metrics writes
+    # happen on a writer thread, so that the model is not idle during context lookups and fsyncs
+    writer = BackgroundWriter() if pipeline_prefetch > 0 else None
 
-        src_class_iri = dp["SrcEntity"]
-        src_class_labels = truncate_labels(src_annotation_index[src_class_iri], 3)
-        tgt_class_iri = dp["TgtEntity"]
-        tgt_cands = eval(dp["TgtCandidates"])
-        temp_progress_bar = enlighten_manager.counter(
-            total=len(tgt_cands), desc="Mapping Prediction", unit="per tgt candidate"
-        )
+    def persist(fn, *args):
+        if writer is not None:
+            writer.submit(fn, *args)
+        else:
+            fn(*args)
 
-        src_class_parents = (
-            get_parent_labels(src_onto, src_annotation_index, src_class_iri) if with_structural_context else None
-        )
-        src_class_children = (
-            get_child_labels(src_onto, src_annotation_index, src_class_iri) if with_structural_context else None
-        )
+    def record(job, tgt_cand_iri, value, model_seconds: float = 0.0):
+        with Stopwatch() as sw:
+            result_dict[job["src"], job["ref"]][tgt_cand_iri] = value
+            persist(journal.append, job["src"], job["ref"], tgt_cand_iri, value)
+        job["pair_metrics"][tgt_cand_iri]["model"] = model_seconds
+        job["pair_metrics"][tgt_cand_iri]["persist"] = sw.elapsed
+
+    def prepare(src_class_iri, tgt_class_iri, tgt_cands):
+        """Everything of a source class before the model call: context, pre-filtering and prompts."""
+        pair_metrics = defaultdict(dict)  # {tgt_cand_iri: {stage: seconds}} of this source class
+        job = dict(src=src_class_iri, ref=tgt_class_iri, num_cands=len(tgt_cands), pair_metrics=pair_metrics)
+        job["src_labels"] = truncate_labels(src_annotation_index[src_class_iri], 3)
+        # read-only here because this may run in the prefetch thread
+        predicted = result_dict.get((src_class_iri, tgt_class_iri), dict())
+
+        with Stopwatch() as src_context_sw:
+            src_class_parents, src_class_children = (
+                get_context_labels(src_onto, src_annotation_index, src_hierarchy_index, src_class_iri)
+                if with_structural_context
+                else (None, None)
+            )
+        job["src_context"], job["src_context_seconds"] = (src_class_parents, src_class_children), src_context_sw.elapsed
 
+        # lexical pre-filter: only the top-ranked candidates are sent to the LLM
+        job["pruned"], job["num_skipped"] = [], 0
+        if predictor.model_type != "bertmap" and (cascade_top_k is not None or cascade_threshold is not None):
+            with Stopwatch() as sw:
+                ranked = rank_candidates_lexically(src_annotation_index[src_class_iri], tgt_annotation_index, tgt_cands)
+                kept, pruned = split_candidates(ranked, top_k=cascade_top_k, threshold=cascade_threshold)
+            for tgt_cand_iri, lexical_score in pruned:
+                if tgt_cand_iri not in predicted:
+                    job["pruned"].append((tgt_cand_iri, pruned_result(lexical_score)))
+                    pair_metrics[tgt_cand_iri]["pruned"] = True
+                else:
+                    job["num_skipped"] += 1
+            tgt_cands = [c for c, _ in kept]
+            for tgt_cand_iri in tgt_cands:
+                pair_metrics[tgt_cand_iri]["cascade"] = sw.elapsed / len(ranked)
+
+        # prompts of the current source class are collected first so that predictors
+        # with a batched interface (e.g., flan-t5) can score them together
+        pending = []
         for tgt_cand_iri in tgt_cands:
             # skip predicted candidates (this is especially useful for GPT-3.5 as the connection is not stable)
-            if tgt_cand_iri in result_dict[src_class_iri, tgt_class_iri].keys():
+            if tgt_cand_iri in predicted:
+                pair_metrics.pop(tgt_cand_iri, None)
+                job["num_skipped"] += 1
                 continue
             tgt_cand_labels = truncate_labels(tgt_annotation_index[tgt_cand_iri], 3)
 
-            tgt_cand_parents = (
-                get_parent_labels(tgt_onto, tgt_annotation_index, tgt_cand_iri) if with_structural_context else None
-            )
-            tgt_cand_children = (
-                get_child_labels(tgt_onto, tgt_annotation_index, tgt_cand_iri) if with_structural_context else None
-            )
+            with Stopwatch() as sw:
+                tgt_cand_parents, tgt_cand_children = (
+                    get_context_labels(tgt_onto, tgt_annotation_index, tgt_hierarchy_index, tgt_cand_iri)
+                    if with_structural_context
+                    else (None, None)
+                )
+            pair_metrics[tgt_cand_iri]["context"] = sw.elapsed
 
-            if predictor.model_type != "bertmap":
+            if listwise and predictor.model_type != "bertmap":
+                # listwise prompts are built per chunk of candidates when predicting
+                pending.append((tgt_cand_iri, (tgt_cand_labels, tgt_cand_parents, tgt_cand_children)))
+            elif predictor.model_type != "bertmap":
                 # compact_list = predictor.model_type == "flan-t5"
                 compact_list = False
-                input_text = integrated_template(
-                    src_class_labels,
-                    tgt_cand_labels,
+                with Stopwatch() as sw:
+                    if prompt_token_budget:
+                        # the labels within the budget are chosen from all (not the 3 longest) labels
+                        input_text, num_tokens = budgeted_template(
+                            src_annotation_index[src_class_iri],
+                            tgt_annotation_index[tgt_cand_iri],
+                            src_class_parents,
+                            tgt_cand_parents,
+                            src_class_children,
+                            tgt_cand_children,
+                            count_tokens=count_tokens,
+                            token_budget=prompt_token_budget,
+                            compact_list=compact_list,
+                        )
+                    else:
+                        input_text = integrated_template(
+                            job["src_labels"],
+                            tgt_cand_labels,
+                            src_class_parents,
+                            tgt_cand_parents,
+                            src_class_children,
+                            tgt_cand_children,
+                            compact_list=compact_list,
+                        )
+                        num_tokens = count_tokens(input_text) if metrics_file else None
+                pair_metrics[tgt_cand_iri]["prompt"] = sw.elapsed
+                if num_tokens is not None:
+                    pair_metrics[tgt_cand_iri]["prompt_tokens"] = num_tokens
+                pending.append((tgt_cand_iri, input_text))
+            else:
+                pending.append((tgt_cand_iri, tgt_annotation_index[tgt_cand_iri]))
+        job["pending"] = pending
+        return job
+
+    def predict(job, temp_progress_bar):
+        """Score the pending candidates of a prepared source class."""
+        src_class_iri, pending = job["src"], job["pending"]
+        pair_metrics = job["pair_metrics"]
+        for tgt_cand_iri, result in job["pruned"]:
+            record(job, tgt_cand_iri, result)
+            temp_progress_bar.update()
+
+        if pending and predictor.model_type == "bertmap":
+            # the bertmap model has no "answer" but it can produce two types of scores
+            with Stopwatch() as sw:
+                results = predictor.predict_bertmap_batch(
+                    src_annotation_index[src_class_iri], [tgt_cand_labels for _, tgt_cand_labels in pending]
+                )
+            for (tgt_cand_iri, _), (bertmap_score, bertmaplt_score) in zip(pending, results):
+                record(job, tgt_cand_iri, (bertmap_score, bertmaplt_score), model_seconds=sw.elapsed / len(pending))
+                temp_progress_bar.update()
+        elif pending and listwise:
+            # one prompt per chunk of candidates that fits the context window; the selected ones are answered
+            # "Yes" and the lexical score orders candidates with the same answer
+            src_class_parents, src_class_children = job["src_context"]
+            cands_context = [cand_context for _, cand_context in pending]
+
+            def render(start, end):
+                return listwise_template(
+                    job["src_labels"],
+                    [tgt_cand_labels for tgt_cand_labels, _, _ in cands_context[start:end]],
                     src_class_parents,
-                    tgt_cand_parents,
                     src_class_children,
-                    tgt_cand_children,
-                    compact_list=compact_list,
+                    [tgt_cand_parents for _, tgt_cand_parents, _ in cands_context[start:end]],
+                    [tgt_cand_children for _, _, tgt_cand_children in cands_context[start:end]],
                 )
-                answer, score = predictor.predict(input_text)
-                result_dict[src_class_iri, tgt_class_iri][tgt_cand_iri] = (answer, score)
-            else:
-                # the bertmap model has no "answer" but it can produce two types of scores
-                bertmap_score, bertmaplt_score = predictor.predict(src_annotation_index[src_class_iri], tgt_annotation_index[tgt_cand_iri])
-                result_dict[src_class_iri, tgt_class_iri][tgt_cand_iri] = (bertmap_score, bertmaplt_score)
 
-            temp_progress_bar.update()
+            lexical_scores = edit_similarity_scores(
+                src_annotation_index[src_class_iri], [tgt_annotation_index[c] for c, _ in pending]
+            )
+            with Stopwatch() as chunk_sw:
+                chunks = listwise_chunks(
+                    render, len(pending), count_tokens, predictor.max_prompt_tokens, listwise_chunk_size
+                )
+            for start, end in chunks:
+                with Stopwatch() as prompt_sw:
+                    input_text = render(start, end)
+                with Stopwatch() as sw:
+                    selected = parse_listwise_answer(predictor.complete(input_text), end - start)
+                prompt_tokens = count_tokens(input_text) if metrics_file else 0
+                for i in range(start, end):
+                    tgt_cand_iri = pending[i][0]
+                    result = listwise_result(i - start in selected, lexical_scores[i])
+                    record(job, tgt_cand_iri, result, sw.elapsed / (end - start))
+                    prompt_seconds = (prompt_sw.elapsed + chunk_sw.elapsed / len(chunks)) / (end - start)
+                    pair_metrics[tgt_cand_iri]["prompt"] = prompt_seconds
+                    if metrics_file:
+                        pair_metrics[tgt_cand_iri]["prompt_tokens"] = prompt_tokens / (end - start)
+                    temp_progress_bar.update()
+        elif pending and hasattr(predictor, "predict_stream"):
+            # concurrent predictors (e.g., gpt) return results as they arrive, each with the duration
+            # of its own request
+            for tgt_cand_iri, result, seconds in predictor.predict_stream(pending):
+                record(job, tgt_cand_iri, result, seconds)
+                temp_progress_bar.update()
+        elif pending and hasattr(predictor, "predict_batch"):
+            with Stopwatch() as sw:
+                results = predictor.predict_batch([input_text for _, input_text in pending], batch_size=batch_size)
+            for (tgt_cand_iri, _), result in zip(pending, results):
+                record(job, tgt_cand_iri, result, sw.elapsed / len(pending))
+                temp_progress_bar.update()
+        else:
+            for tgt_cand_iri, input_text in pending:
+                with Stopwatch() as sw:
+                    result = predictor.predict(input_text)
+                record(job, tgt_cand_iri, result, sw.elapsed)
+                temp_progress_bar.update()
+
+    def finish(job):
+        """Make the results of a source class durable and log its metrics."""
+        pair_metrics = job["pair_metrics"]
+        with Stopwatch() as sw:
+            journal.flush()
+        # class-level costs are shared evenly among the scored pairs
+        for m in pair_metrics.values():
+            m["context"] = m.get("context", 0.0) + job["src_context_seconds"] / len(pair_metrics)
+            m["persist"] = m.get("persist", 0.0) + sw.elapsed / len(pair_metrics)
+        metrics.log_pairs(job["src"], job["ref"], pair_metrics)
+
+    rows = iter_candidates(test_cands, result_dict)
+    jobs = (prepare(*row) for row in rows)
+    if pipeline_prefetch > 0:
+        jobs = prefetch(jobs, pipeline_prefetch)
+
+    try:
+        for job in jobs:
+            temp_progress_bar = enlighten_manager.counter(
+                total=job["num_cands"],
+                count=job["num_skipped"],
+                desc="Mapping Prediction",
+                unit="per tgt candidate",
+                leave=False,
+            )
+            predict(job, temp_progress_bar)
+            temp_progress_bar.close()
+            progress_bar.update()
+            persist(finish, job)
+    finally:
+        # on an error, the prefetch thread is stopped and the results scored so far are still written
+        jobs.close()
+        try:
+            if writer is not None:
+                writer.close()
+        finally:
+            journal.close()
+
+    compact_results(result_file, result_dict)
 
-        progress_bar.update()
-        save_file(result_dict, result_file)
+    return metrics.close(predictor)
@@ -0,0 +1,102 @@
+#    Copyright 2023 Yuan He
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from typing import Optional
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from .journal import jsonable
+
+
+class PromptCache:
+    """Persistent prompt/response cache backed by SQLite.
+
+    Entries are keyed by a hash of the model identity (model name and decoding parameters)
+    and the exact model input, so the cache can be shared across runs, result files and datasets.
+    The least recently used entries are evicted once `max_entries` is exceeded.
+    """
+
+    def __init__(self, cache_file: str, max_entries: Optional[int] = 1000000):
+        self.cache_file = cache_file
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(cache_file, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, last_access REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS cache_last_access ON cache (last_access)")
+        self.conn.commit()
+        self.num_entries = self.conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+    @staticmethod
+    def make_key(model_identity: dict, model_input):
+        """Content hash of the model identity and the model input (a prompt or a tuple of label sets)."""
+        if isinstance(model_input, (tuple, list)):
+            model_input = [sorted(x) if isinstance(x, (set, frozenset)) else x for x in model_input]
+        payload = json.dumps([model_identity, model_input], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str):
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.conn.execute("UPDATE cache SET last_access = ? WHERE key = ?", (time.time(), key))
+            self.conn.commit()
+        value = json.loads(row[0])
+        return tuple(value) if isinstance(value, list) else value
+
+    def put(self, key: str, value):
+        with self.lock:
+            cursor = self.conn.execute(
+                "INSERT OR REPLACE INTO cache (key, value, last_access) VALUES (?, ?, ?)",
+                (key, json.dumps(jsonable(value)), time.time()),
+            )
+            self.num_entries += cursor.rowcount
+            self._evict()
+            self.conn.commit()
+
+    def _evict(self):
+        # `INSERT OR REPLACE` reports one changed row either way, so recount before evicting
+        if self.max_entries is None or self.num_entries <= self.max_entries:
+            return
+        self.num_entries = self.conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+        excess = self.num_entries - self.max_entries
+        if excess > 0:
+            self.conn.execute(
+                "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY last_access LIMIT ?)", (excess,)
+            )
+            self.num_entries -= excess
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": self.num_entries,
+        }
+
+    def close(self):
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
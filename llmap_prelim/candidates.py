@@ -0,0 +1,139 @@
+#    Copyright 2023 Yuan He
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from typing import Iterable, List, Optional, Tuple, Union
+import os
+import ast
+import csv
+import sys
+import json
+import numpy as np
+from pandas import DataFrame
+from .files import publish_dir, tmp_dir_of
+
+# candidate lists of full-ontology runs can exceed the default field size limit
+csv.field_size_limit(sys.maxsize)
+
+
+def parse_candidate_list(cell: Union[str, list]):
+    """Parse a `TgtCandidates` cell (the `repr` of a list of IRIs) without `eval`."""
+    if not isinstance(cell, str):
+        return list(cell)
+    cell = cell.strip()
+    if cell == "[]":
+        return []
+    # fast path for the common "['iri', 'iri', ...]" layout; anything unusual goes to `literal_eval`
+    if cell.startswith("['") and cell.endswith("']"):
+        cands = cell[2:-2].split("', '")
+        if not any("'" in c or "\\" in c for c in cands):
+            return cands
+    return list(ast.literal_eval(cell))
+
+
+def read_candidates_tsv(cand_file: str):
+    """Stream `(src_class_iri, tgt_class_iri, tgt_cands)` rows from a candidate TSV file."""
+    with open(cand_file, "r", encoding="utf-8", newline="") as f:
+        reader = csv.reader(f, delimiter="\t")
+        header = next(reader)
+        src_col, tgt_col, cands_col = [header.index(c) for c in ["SrcEntity", "TgtEntity", "TgtCandidates"]]
+        for row in reader:
+            yield row[src_col], row[tgt_col], parse_candidate_list(row[cands_col])
+
+
+def read_reference_pairs(ref_file: str):
+    """Read the `(SrcEntity, TgtEntity)` pairs of a reference TSV file such as `full_refs.tsv`."""
+    with open(ref_file, "r", encoding="utf-8", newline="") as f:
+        reader = csv.reader(f, delimiter="\t")
+        header = next(reader)
+        src_col, tgt_col = header.index("SrcEntity"), header.index("TgtEntity")
+        return [(row[src_col], row[tgt_col]) for row in reader]
+
+
+def write_candidates_binary(rows: Iterable[Tuple[str, str, List[str]]], out_dir: str):
+    """Write candidate rows into a compact columnar format.
+
+    IRIs are interned into `iris.txt`; the source, reference and candidate columns are raw int arrays
+    (the candidates in CSR layout) that are appended as rows stream in and memory-mapped on reading.
+    The files are written into a temporary directory that replaces `out_dir` once complete, so that
+    concurrent writers (e.g., shard workers generating the same candidates) do not interleave.
+    """
+    final_dir, out_dir = out_dir, tmp_dir_of(out_dir)
+    os.makedirs(out_dir, exist_ok=True)
+    iri_to_id = dict()
+
+    def intern(iri):
+        return iri_to_id.setdefault(iri, len(iri_to_id))
+
+    num_rows, num_cands = 0, 0
+    files = {name: open(os.path.join(out_dir, f"{name}.bin"), "wb") for name in ["src", "ref", "cand_indptr", "cands"]}
+    try:
+        files["cand_indptr"].write(np.zeros(1, dtype=np.int64).tobytes())
+        for src_class_iri, tgt_class_iri, tgt_cands in rows:
+            files["src"].write(np.int32(intern(src_class_iri)).tobytes())
+            files["ref"].write(np.int32(intern(tgt_class_iri)).tobytes())
+            files["cands"].write(np.array([intern(c) for c in tgt_cands], dtype=np.int32).tobytes())
+            num_rows += 1
+            num_cands += len(tgt_cands)
+            files["cand_indptr"].write(np.int64(num_cands).tobytes())
+    finally:
+        for f in files.values():
+            f.close()
+    with open(os.path.join(out_dir, "iris.txt"), "w", encoding="utf-8") as f:
+        f.write("\n".join(iri_to_id.keys()))
+    with open(os.path.join(out_dir, "meta.json"), "w") as f:
+        json.dump({"num_rows": num_rows, "num_cands": num_cands}, f)
+    publish_dir(out_dir, final_dir)
+
+
+def read_candidates_binary(cand_dir: str):
+    """Stream `(src_class_iri, tgt_class_iri, tgt_cands)` rows from the columnar candidate format."""
+    with open(os.path.join(cand_dir, "meta.json"), "r") as f:
+        meta = json.load(f)
+    with open(os.path.join(cand_dir, "iris.txt"), "r", encoding="utf-8") as f:
+        iris = f.read().split("\n")
+
+    def column(name, dtype, length):
+        if length == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(os.path.join(cand_dir, f"{name}.bin"), dtype=dtype, mode="r", shape=(length,))
+
+    src = column("src", np.int32, meta["num_rows"])
+    ref = column("ref", np.int32, meta["num_rows"])
+    cand_indptr = column("cand_indptr", np.int64, meta["num_rows"] + 1)
+    cands = column("cands", np.int32, meta["num_cands"])
+    for i in range(meta["num_rows"]):
+        yield iris[src[i]], iris[ref[i]], [iris[c] for c in cands[cand_indptr[i] : cand_indptr[i + 1]]]
+
+
+def iter_candidates(test_cands: Union[DataFrame, str, Iterable], result_dict: Optional[dict] = None):
+    """Stream candidate rows from a DataFrame, a TSV file, a columnar candidate directory or any iterable.
+
+    Rows whose candidates are all present in `result_dict` are skipped.
+    """
+    if isinstance(test_cands, DataFrame):
+        rows = (
+            (src, tgt, parse_candidate_list(cands))
+            for src, tgt, cands in zip(test_cands["SrcEntity"], test_cands["TgtEntity"], test_cands["TgtCandidates"])
+        )
+    elif isinstance(test_cands, str):
+        rows = read_candidates_binary(test_cands) if os.path.isdir(test_cands) else read_candidates_tsv(test_cands)
+    else:
+        rows = test_cands
+
+    for src_class_iri, tgt_class_iri, tgt_cands in rows:
+        if result_dict is not None and (src_class_iri, tgt_class_iri) in result_dict:
+            predicted = result_dict[src_class_iri, tgt_class_iri]
+            if all(c in predicted for c in tgt_cands):
+                continue
+        yield src_class_iri, tgt_class_iri, tgt_cands
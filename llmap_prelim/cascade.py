@@ -0,0 +1,153 @@
+#    Copyright 2023 Yuan He
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from typing import Iterable, List, Optional, Union
+import itertools
+import numpy as np
+from pandas import DataFrame
+from .candidates import iter_candidates
+
+# pruned candidates are recorded as "No" with the lexical score shifted below every LLM score
+# (those lie in [-1, 1]), so they rank last but keep their lexical order for Hits@1/MRR
+PRUNED_ANSWER = "No"
+PRUNED_SCORE_OFFSET = -2.0
+
+
+def levenshtein_similarities(label_pairs: List[tuple]):
+    """Normalised Levenshtein similarities of many string pairs at once.
+
+    The dynamic programme runs row by row over the characters of the first strings while every
+    pair is updated in the same NumPy operation; the result equals `textdistance`'s
+    `levenshtein.normalized_similarity`, i.e., `1 - distance / max(len(s), len(t))`.
+    """
+    if not label_pairs:
+        return np.zeros(0)
+    srcs, tgts = zip(*label_pairs)
+    src_lens = np.array([len(x) for x in srcs])
+    tgt_lens = np.array([len(x) for x in tgts])
+    max_src_len, max_tgt_len = int(src_lens.max()), int(tgt_lens.max())
+    # code points padded with distinct negative values so that padding never matches
+    src_codes = np.full((len(srcs), max_src_len), -1, dtype=np.int64)
+    tgt_codes = np.full((len(tgts), max_tgt_len), -2, dtype=np.int64)
+    for i, (x, y) in enumerate(label_pairs):
+        src_codes[i, : len(x)] = [ord(c) for c in x]
+        tgt_codes[i, : len(y)] = [ord(c) for c in y]
+
+    rows = np.arange(len(srcs))
+    prev = np.tile(np.arange(max_tgt_len + 1), (len(srcs), 1))
+    distances = tgt_lens.copy()  # pairs with an empty first string
+    for i in range(1, max_src_len + 1):
+        cur = np.empty_like(prev)
+        cur[:, 0] = i
+        substitution = prev[:, :-1] + (src_codes[:, i - 1 : i] != tgt_codes)
+        deletion = prev[:, 1:] + 1
+        best = np.minimum(substitution, deletion)
+        for j in range(1, max_tgt_len + 1):
+            cur[:, j] = np.minimum(best[:, j - 1], cur[:, j - 1] + 1)
+        finished = src_lens == i
+        distances[finished] = cur[rows[finished], tgt_lens[finished]]
+        prev = cur
+
+    max_lens = np.maximum(src_lens, tgt_lens)
+    return np.where(max_lens == 0, 1.0, 1.0 - distances / np.maximum(max_lens, 1))
+
+
+def edit_similarity_scores(src_class_labels: Iterable[str], tgt_cands_labels: List[Iterable[str]]):
+    """The BERTMapLt score of a source class against each target candidate.
+
+    A shared label gives 1.0; otherwise the max normalised edit similarity over all label pairs.
+    All label pairs of all candidates are computed in one vectorised pass.
+    """
+    src_class_labels = set(src_class_labels)
+    label_pairs, owners = [], []
+    for k, tgt_class_labels in enumerate(tgt_cands_labels):
+        for pair in itertools.product(src_class_labels, set(tgt_class_labels)):
+            label_pairs.append(pair)
+            owners.append(k)
+    scores = np.zeros(len(tgt_cands_labels))
+    np.maximum.at(scores, np.array(owners, dtype=np.int64), levenshtein_similarities(label_pairs))
+    for k, tgt_class_labels in enumerate(tgt_cands_labels):
+        if src_class_labels.intersection(tgt_class_labels):
+            scores[k] = 1.0
+    return scores.tolist()
+
+
+def edit_similarity_score(src_class_labels: Iterable[str], tgt_class_labels: Iterable[str]):
+    """The BERTMapLt score: 1.0 for a shared label, else the max normalised edit similarity of all label pairs."""
+    return edit_similarity_scores(src_class_labels, [tgt_class_labels])[0]
+
+
+def rank_candidates_lexically(src_class_labels: Iterable[str], tgt_annotation_index: dict, tgt_cands: List[str]):
+    """Sort the target candidates by their edit similarity to the source class labels."""
+    scores = edit_similarity_scores(src_class_labels, [tgt_annotation_index[c] for c in tgt_cands])
+    return sorted(zip(tgt_cands, scores), key=lambda x: x[1], reverse=True)
+
+
+def split_candidates(ranked_cands: list, top_k: Optional[int] = None, threshold: Optional[float] = None):
+    """Split lexically ranked candidates into those sent to the LLM and those pruned.
+
+    A candidate is kept if it is within the `top_k` or scores at least `threshold`; with both unset,
+    nothing is pruned.
+    """
+    if top_k is None and threshold is None:
+        return ranked_cands, []
+    kept, pruned = [], []
+    for i, (c, score) in enumerate(ranked_cands):
+        if (top_k is not None and i < top_k) or (threshold is not None and score >= threshold):
+            kept.append((c, score))
+        else:
+            pruned.append((c, score))
+    return kept, pruned
+
+
+def pruned_result(lexical_score: float):
+    return PRUNED_ANSWER, lexical_score + PRUNED_SCORE_OFFSET
+
+
+def cascade_report(
+    test_cands: Union[DataFrame, str, Iterable],
+    src_annotation_index: dict,
+    tgt_annotation_index: dict,
+    top_ks: List[int] = [1, 5, 10, 20, 50, 100],
+    thresholds: List[float] = [],
+):
+    """Recall of the reference target vs. the number of LLM calls for each cascade setting.
+
+    Recall is measured over the matched source classes only; calls over all rows.
+    """
+    settings = [("top_k", k) for k in top_ks] + [("threshold", t) for t in thresholds]
+    recalled = {s: 0 for s in settings}
+    calls = {s: 0 for s in settings}
+    num_matched, num_cands = 0, 0
+
+    for src_class_iri, tgt_class_iri, tgt_cands in iter_candidates(test_cands):
+        ranked = rank_candidates_lexically(src_annotation_index[src_class_iri], tgt_annotation_index, tgt_cands)
+        num_cands += len(ranked)
+        num_matched += tgt_class_iri != "UnMatched"
+        for name, value in settings:
+            kept, _ = split_candidates(ranked, **{name: value})
+            calls[name, value] += len(kept)
+            recalled[name, value] += tgt_class_iri in [c for c, _ in kept]
+
+    report = []
+    for name, value in settings:
+        report.append(
+            {
+                name: value,
+                "recall": recalled[name, value] / num_matched if num_matched else 0.0,
+                "calls": calls[name, value],
+                "call_fraction": calls[name, value] / num_cands if num_cands else 0.0,
+            }
+        )
+    return report
@@ -0,0 +1,182 @@
+#    Copyright 2023 Yuan He
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from typing import Callable, Iterable, Optional, Tuple, Any
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import threading
+import time
+import random
+import openai
+
+# errors worth another attempt; anything else (e.g., authentication, invalid request) is fatal
+RETRYABLE_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.Timeout,
+    openai.error.APIConnectionError,
+    openai.error.ServiceUnavailableError,
+    openai.error.TryAgain,
+    # server errors other than 503 (e.g., 500 and 502); see `is_retryable`
+    openai.error.APIError,
+)
+
+
+def is_retryable(error: Exception):
+    """Whether an error is worth another attempt; `APIError`s only if they are server-side (5xx)."""
+    if isinstance(error, openai.error.APIError):
+        return error.http_status is None or error.http_status >= 500
+    return isinstance(error, RETRYABLE_ERRORS)
+
+
+class RetriesExceededError(Exception):
+    """A retryable error persisted through all retries; the last error is the `__cause__`."""
+
+
+def call_with_retries(
+    fn: Callable,
+    *args,
+    max_retries: int = 5,
+    backoff_in_seconds: float = 1.0,
+    on_retry: Optional[Callable[[float], None]] = None,
+):
+    """Call `fn` with exponential waiting time on retryable errors; `on_retry` receives each waiting time.
+
+    Once `max_retries` retries are exhausted, a `RetriesExceededError` is raised from the last error.
+    """
+    retries = 0
+    while True:
+        try:
+            return fn(*args)
+        except RETRYABLE_ERRORS as e:
+            if not is_retryable(e):
+                raise
+            if retries == max_retries:
+                raise RetriesExceededError(f"Retries exceeded ({max_retries}): {e!r}") from e
+            sleep = backoff_in_seconds * 2**retries + random.uniform(0, 1)
+            if on_retry:
+                on_retry(sleep)
+            time.sleep(sleep)
+            retries += 1
+
+
+class RateLimiter:
+    """Token-bucket limiter for requests-per-minute and tokens-per-minute budgets.
+
+    A budget of `None` means unlimited.
+    """
+
+    def __init__(self, requests_per_minute: Optional[int] = None, tokens_per_minute: Optional[int] = None):
+        self.budgets = [requests_per_minute, tokens_per_minute]
+        self.available = [float(b) if b else 0.0 for b in self.budgets]
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.last_refill
+        self.last_refill = now
+        for i, budget in enumerate(self.budgets):
+            if budget:
+                self.available[i] = min(float(budget), self.available[i] + elapsed * budget / 60)
+
+    def acquire(self, num_tokens: int = 0):
+        """Block until one request consuming `num_tokens` tokens fits into both budgets."""
+        # a single request can never exceed the bucket capacity
+        needed = [1.0, float(min(num_tokens, self.budgets[1])) if self.budgets[1] else 0.0]
+        while True:
+            with self.lock:
+                self._refill()
+                wait_time = 0.0
+                for i, budget in enumerate(self.budgets):
+                    if budget and self.available[i] < needed[i]:
+                        wait_time = max(wait_time, (needed[i] - self.available[i]) * 60 / budget)
+                if wait_time == 0.0:
+                    for i, budget in enumerate(self.budgets):
+                        if budget:
+                            self.available[i] -= needed[i]
+                    return
+            time.sleep(wait_time)
+
+
+class GPTDispatcher:
+    """Keep up to `max_in_flight` GPT requests running concurrently under the given rate limits.
+
+    `request_fn` issues a single request for an input text; retryable errors are retried with
+    exponential waiting time while fatal errors stop the dispatching and are re-raised.
+    """
+
+    def __init__(
+        self,
+        request_fn: Callable[[str], Any],
+        max_in_flight: int = 8,
+        requests_per_minute: Optional[int] = 3500,
+        tokens_per_minute: Optional[int] = 90000,
+        max_tokens: int = 512,
+        max_retries: int = 5,
+        on_retry: Optional[Callable[[float], None]] = None,
+    ):
+        self.request_fn = request_fn
+        self.on_retry = on_retry
+        self.max_in_flight = max_in_flight
+        self.rate_limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+        self.max_tokens = max_tokens
+        self.max_retries = max_retries
+
+    @staticmethod
+    def estimate_tokens(input_text: str):
+        """Rough token estimate (4 characters per token) used for the tokens-per-minute budget."""
+        return len(input_text) // 4 + 1
+
+    def _limited_request(self, input_text: str):
+        self.rate_limiter.acquire(self.estimate_tokens(input_text) + self.max_tokens)
+        start = time.perf_counter()
+        result = self.request_fn(input_text)
+        return result, time.perf_counter() - start
+
+    def _request(self, input_text: str):
+        """The result of a request and the seconds of its successful attempt (without rate limiting and retries)."""
+        return call_with_retries(
+            self._limited_request, input_text, max_retries=self.max_retries, on_retry=self.on_retry
+        )
+
+    def imap_unordered(self, keyed_texts: Iterable[Tuple[Any, str]]):
+        """Yield `(key, result, seconds)` for each `(key, input_text)` as soon as its request completes.
+
+        `seconds` is the duration of the request itself, unlike the time between two results, which
+        overlaps with the other requests in flight.
+        """
+        keyed_texts = iter(keyed_texts)
+        with ThreadPoolExecutor(max_workers=self.max_in_flight) as executor:
+            in_flight = dict()
+
+            def submit_next():
+                for key, input_text in keyed_texts:
+                    in_flight[executor.submit(self._request, input_text)] = key
+                    return True
+                return False
+
+            # submit lazily so that back-pressure is kept at `max_in_flight` requests
+            for _ in range(self.max_in_flight):
+                if not submit_next():
+                    break
+            try:
+                while in_flight:
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        key = in_flight.pop(future)
+                        result, seconds = future.result()
+                        yield key, result, seconds
+                        submit_next()
+            finally:
+                for future in in_flight:
+                    future.cancel()
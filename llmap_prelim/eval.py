@@ -12,8 +12,12 @@
 #    See the License for the specific language governing permissions and
 #   limitations under the License.
 
+from typing import Iterable, Sequence
+from collections import defaultdict
+import numpy as np
 from deeponto.align.mapping import ReferenceMapping, EntityMapping
 from deeponto.align.evaluation import AlignmentEvaluator
+from .store import ResultStore, is_positive_answer
 
 
 def unpack_results_for_llm(result_dict: dict, threshold: float = 0.0):
@@ -23,10 +27,12 @@ def unpack_results_for_llm(result_dict: dict, threshold: float = 0.0):
 
     for (src_ref, tgt_ref), v in result_dict.items():
         cur_mappings = []
-        for tgt_cand, (answer, score) in v.items():
+        for tgt_cand, value in v.items():
+            # escalated results carry the local and remote answers as a third element
+            answer, score = value[:2]
             mapping = EntityMapping(src_ref, tgt_cand, "=", score)
             # final prediction determines by "Yes" and/or threshold
-            if ("Yes" in answer or "yes" in answer or "are identical" in answer) and score >= threshold:
+            if is_positive_answer(answer) and score >= threshold:
                 final_preds.append(mapping)
             else:
                 mapping.relation = "!="   
@@ -36,6 +42,40 @@ def unpack_results_for_llm(result_dict: dict, threshold: float = 0.0):
 
     return final_preds, ranked_preds
 
+def escalation_view(result_dict: dict, decision: str = "combined"):
+    """Results of an escalation run as decided with escalation (`"combined"`) or by the local model alone (`"local"`).
+
+    The view has the usual `(answer, score)` values and can be passed to `unpack_results_for_llm`
+    or `ResultStore.from_results`.
+    """
+    assert decision in ["combined", "local"]
+    view = defaultdict(dict)
+    for k, v in result_dict.items():
+        for tgt_cand, value in v.items():
+            if decision == "local" and len(value) > 2:
+                value = value[2]["local"]
+            view[k][tgt_cand] = tuple(value[:2])
+    return view
+
+
+def escalation_stats(result_dict: dict):
+    """How many pairs were escalated and how often the remote model overturned the local answer."""
+    num_pairs, num_escalated, num_overturned = 0, 0, 0
+    for v in result_dict.values():
+        for value in v.values():
+            num_pairs += 1
+            if len(value) > 2 and value[2]["remote"] is not None:
+                num_escalated += 1
+                local_answer, remote_answer = value[2]["local"][0], value[2]["remote"][0]
+                num_overturned += is_positive_answer(local_answer) != is_positive_answer(remote_answer)
+    return {
+        "pairs": num_pairs,
+        "escalated": num_escalated,
+        "escalation_rate": num_escalated / max(num_pairs, 1),
+        "overturned": num_overturned,
+    }
+
+
 def unpack_results_for_bertmap(result_dict: dict, bertmap_threshold: float = 0.0, bertmaplt_threshold: float = 0.0):
     
     bertmap_final_preds = []
@@ -71,32 +111,191 @@ def unpack_results_for_bertmap(result_dict: dict, bertmap_threshold: float = 0.0
     return bertmap_final_preds, bertmap_ranked_preds, bertmaplt_final_preds, bertmaplt_ranked_preds
     
 
+def unpack_result_store(store: ResultStore, threshold: float = 0.0, score_column: str = "score"):
+    """Same output as `unpack_results_for_llm` (or one score of `unpack_results_for_bertmap`) from a result store.
+
+    Decisions and rankings are computed on the arrays; the `EntityMapping` objects are only created here
+    for `evaluate` and other consumers of the mapping lists.
+    """
+    decisions = store.decisions(threshold, score_column)
+    scores = getattr(store, score_column)
+    iris, src_iris = store.iris, [store.iris[i] for i in store.src.tolist()]
+    mappings = [
+        EntityMapping(src_iris[g], iris[c], "=" if d else "!=", s)
+        for g, c, d, s in zip(store.group_ids().tolist(), store.cand.tolist(), decisions.tolist(), scores.tolist())
+    ]
+    final_preds = [m for m, d in zip(mappings, decisions.tolist()) if d]
+    ranked_preds = dict()
+    order, indptr = store.rank(score_column).tolist(), store.group_indptr.tolist()
+    for g, ref in enumerate(store.ref.tolist()):
+        ranked_preds[src_iris[g], iris[ref]] = [mappings[i] for i in order[indptr[g] : indptr[g + 1]]]
+    return final_preds, ranked_preds
+
+
 def evaluate(final_preds, ranked_preds, refs, include_latex: bool = False):
 
     hits1 = 0
     reject = 0
 
     _ranked = []
+    num_unmatched = 0
     for (src_ref, tgt_ref), cand_mappings in ranked_preds.items():
+        if tgt_ref == "UnMatched":
+            num_unmatched += 1
+            if cand_mappings[0].relation == "!=":
+                reject += 1
+            continue
         if cand_mappings[0].tail == tgt_ref:
             hits1 += 1
-        elif cand_mappings[0].relation == "!=" and tgt_ref == "UnMatched":
-            reject += 1
-        else:
-            pass
-            # print((src_ref, tgt_ref))
         _ranked.append((ReferenceMapping(src_ref, tgt_ref, "="), cand_mappings))
 
     matching_scores = AlignmentEvaluator().f1(final_preds, refs)
 
-    mrr = AlignmentEvaluator().mean_reciprocal_rank(_ranked[:50])
+    # ranking metrics over the source classes with a reference mapping, rejection over the others
+    mrr = AlignmentEvaluator().mean_reciprocal_rank(_ranked) if _ranked else 0.0
 
     all_scores = matching_scores
-    all_scores["Hits@1"] = hits1 / 50
+    all_scores["Hits@1"] = hits1 / max(len(_ranked), 1)
     all_scores["MRR"] = mrr
-    all_scores["RR"] = reject / 50
+    all_scores["RR"] = reject / max(num_unmatched, 1)
 
     if include_latex:
         print(" & ".join([str(round(s, 3)) for s in all_scores.values()]))
 
     return all_scores
+
+
+class StoreEvaluator:
+    """NumPy evaluation of a `ResultStore` against reference mappings (`(src, tgt)` pairs or `ReferenceMapping`s).
+
+    Everything that does not depend on the threshold (reference lookups, rankings) is computed once, so that
+    `sweep` gives P/R/F1 at every distinct threshold in one sorted pass and `evaluate` is cheap to repeat.
+    Ranking metrics are over the `(src, ref)` groups with a reference, the rejection rate (RR) over the
+    `"UnMatched"` ones, as in `evaluate`.
+    """
+
+    def __init__(self, store: ResultStore, refs: Iterable, score_column: str = "score"):
+        self.store = store
+        self.scores = np.asarray(getattr(store, score_column))
+        self.group_ids = store.group_ids()
+        group_src = np.asarray(store.src, dtype=np.int64)
+        group_ref = np.asarray(store.ref, dtype=np.int64)
+        cand = np.asarray(store.cand, dtype=np.int64)
+        num_iris = len(store.iris)
+
+        # references that cannot be predicted (an IRI unseen in the results) still count for recall
+        iri_to_id = {iri: i for i, iri in enumerate(store.iris)}
+        refs = {r.to_tuple() if hasattr(r, "to_tuple") else tuple(r) for r in refs}
+        self.num_refs = len(refs)
+        ref_ids = np.array(
+            [(iri_to_id.get(s, -1), iri_to_id.get(t, -1)) for s, t in refs], dtype=np.int64
+        ).reshape(-1, 2)
+        ref_ids = ref_ids[(ref_ids >= 0).all(axis=1)]
+        row_keys = group_src[self.group_ids] * num_iris + cand
+        self.is_ref = np.isin(row_keys, ref_ids[:, 0] * num_iris + ref_ids[:, 1])
+
+        # a (src, cand) pair ranked in more than one group is predicted once, with its best eligible score
+        self.eligible = np.asarray(store.decisions(-np.inf, score_column))
+        rows = np.flatnonzero(self.eligible)
+        rows = rows[np.lexsort((-self.scores[rows], row_keys[rows]))]
+        first = np.ones(len(rows), dtype=bool)
+        first[1:] = row_keys[rows][1:] != row_keys[rows][:-1]
+        self.pred_rows = rows[first]
+
+        # per-group references for bootstrapping recall; those of unseen source classes stay constant
+        ref_src_counts = np.bincount(ref_ids[:, 0], minlength=num_iris)
+        groups_per_src = np.bincount(group_src, minlength=num_iris)
+        self.group_num_refs = ref_src_counts[group_src] / np.maximum(groups_per_src[group_src], 1)
+        self.other_refs = self.num_refs - self.group_num_refs.sum()
+
+        indptr = np.asarray(store.group_indptr)
+        group_sizes = np.diff(indptr)
+        order = store.rank(score_column)
+        position = np.empty(len(order), dtype=np.int64)
+        position[order] = np.arange(len(order)) - np.repeat(indptr[:-1], group_sizes)
+        ref_rows = np.flatnonzero(cand == group_ref[self.group_ids])
+        self.ref_rank = np.full(store.num_groups, np.inf)
+        np.minimum.at(self.ref_rank, self.group_ids[ref_rows], position[ref_rows])
+
+        unmatched_id = iri_to_id.get("UnMatched", -1)
+        self.matched = (group_ref != unmatched_id) & (group_sizes > 0)
+        self.unmatched = (group_ref == unmatched_id) & (group_sizes > 0)
+        self.top_rows = order[np.minimum(indptr[:-1], max(len(order) - 1, 0))]
+
+    def sweep(self):
+        """P/R/F1 at every distinct score threshold (a pair is predicted if its score is at least the threshold)."""
+        rows = self.pred_rows[np.argsort(-self.scores[self.pred_rows], kind="stable")]
+        scores = self.scores[rows]
+        tp = np.cumsum(self.is_ref[rows])
+        num_preds = np.arange(1, len(rows) + 1)
+        last = np.ones(len(rows), dtype=bool)
+        last[:-1] = scores[1:] != scores[:-1]
+        thresholds, tp, num_preds = scores[last], tp[last], num_preds[last]
+        precision = tp / num_preds
+        recall = tp / max(self.num_refs, 1)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            f1 = np.nan_to_num(2 * precision * recall / (precision + recall))
+        return {"threshold": thresholds, "P": precision, "R": recall, "F1": f1}
+
+    def best_threshold(self, metric: str = "F1"):
+        sweep = self.sweep()
+        i = int(np.argmax(sweep[metric]))
+        return {k: float(v[i]) for k, v in sweep.items()}
+
+    def _group_stats(self, threshold: float, ks: Sequence[int]):
+        preds = self.pred_rows[self.scores[self.pred_rows] >= threshold]
+        num_groups = self.store.num_groups
+        decisions = self.eligible & (self.scores >= threshold)
+        stats = {
+            "tp": np.bincount(self.group_ids[preds], weights=self.is_ref[preds], minlength=num_groups),
+            "num_preds": np.bincount(self.group_ids[preds], minlength=num_groups).astype(np.float64),
+            "num_refs": self.group_num_refs,
+            "matched": self.matched.astype(np.float64),
+            "unmatched": self.unmatched.astype(np.float64),
+            "reject": (self.unmatched & ~decisions[self.top_rows]).astype(np.float64),
+            "rr": np.where(self.matched, 1 / (self.ref_rank + 1), 0.0),
+        }
+        for k in ks:
+            stats[f"hits@{k}"] = (self.matched & (self.ref_rank < k)).astype(np.float64)
+        return stats
+
+    def _scores(self, totals: dict, ks: Sequence[int]):
+        precision = totals["tp"] / max(totals["num_preds"], 1)
+        recall = totals["tp"] / max(totals["num_refs"] + self.other_refs, 1)
+        scores = {"P": precision, "R": recall, "F1": 2 * precision * recall / (precision + recall or 1)}
+        for k in ks:
+            scores[f"Hits@{k}"] = totals[f"hits@{k}"] / max(totals["matched"], 1)
+        scores["MRR"] = totals["rr"] / max(totals["matched"], 1)
+        scores["RR"] = totals["reject"] / max(totals["unmatched"], 1)
+        return scores
+
+    def evaluate(
+        self,
+        threshold: float = 0.0,
+        ks: Sequence[int] = (1,),
+        num_bootstrap: int = 0,
+        confidence: float = 0.95,
+        seed: int = 0,
+    ):
+        """The scores of `evaluate` at a threshold, with `{metric}_CI` bootstrap intervals if `num_bootstrap > 0`.
+
+        Bootstrap samples resample the `(src, ref)` groups with replacement.
+        """
+        stats = self._group_stats(threshold, ks)
+        names = list(stats.keys())
+        matrix = np.stack([stats[n] for n in names], axis=1)
+        all_scores = self._scores(dict(zip(names, matrix.sum(axis=0))), ks)
+
+        if num_bootstrap > 0:
+            rng = np.random.default_rng(seed)
+            num_groups = len(matrix)
+            samples = {k: [] for k in all_scores}
+            for _ in range(num_bootstrap):
+                weights = np.bincount(rng.integers(0, num_groups, num_groups), minlength=num_groups)
+                for k, v in self._scores(dict(zip(names, weights @ matrix)), ks).items():
+                    samples[k].append(v)
+            alpha = (1 - confidence) / 2
+            for k, v in samples.items():
+                all_scores[f"{k}_CI"] = tuple(np.quantile(v, [alpha, 1 - alpha]))
+
+        return {k: (float(v) if not isinstance(v, tuple) else tuple(map(float, v))) for k, v in all_scores.items()}
@@ -0,0 +1,44 @@
+#    Copyright 2023 Yuan He
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import shutil
+
+
+def tmp_dir_of(out_dir: str):
+    """A private directory to build `out_dir` in before `publish_dir` (one per process)."""
+    return f"{out_dir.rstrip(os.sep)}.tmp{os.getpid()}"
+
+
+def publish_dir(tmp_dir: str, out_dir: str):
+    """Move a completely written `tmp_dir` into place as `out_dir`.
+
+    Concurrent writers (e.g., shard workers) each build in their own temporary directory, so readers
+    never see a half-written `out_dir`. A previous `out_dir` is moved aside and removed; if another
+    writer publishes first, its copy is kept and `tmp_dir` is discarded.
+    """
+    old_dir = None
+    if os.path.exists(out_dir):
+        old_dir = f"{tmp_dir}.old"
+        try:
+            os.rename(out_dir, old_dir)
+        except FileNotFoundError:
+            old_dir = None
+    try:
+        os.rename(tmp_dir, out_dir)
+    except OSError:
+        # another writer has published in the meantime
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    if old_dir is not None:
+        shutil.rmtree(old_dir, ignore_errors=True)
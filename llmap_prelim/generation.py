@@ -0,0 +1,150 @@
+#    Copyright 2023 Yuan He
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from typing import Iterable, List, Optional, Tuple
+from array import array
+import numpy as np
+import scipy.sparse as sp
+
+
+def char_ngrams(label: str, ngram_range: Tuple[int, int] = (3, 4)):
+    """Character n-grams of a lower-cased label padded with a space on each side."""
+    padded = f" {label.lower()} "
+    min_n, max_n = ngram_range
+    return [padded[i : i + n] for n in range(min_n, max_n + 1) for i in range(len(padded) - n + 1)]
+
+
+class LexicalIndex:
+    """Sparse character n-gram TF-IDF index over all labels of the target classes.
+
+    Each row of the (sub-linear tf, l2-normalised) matrix is a target label; a class is scored by its
+    best-matching label so that synonyms are not averaged out.
+    """
+
+    def __init__(self, annotation_index: dict, ngram_range: Tuple[int, int] = (3, 4), max_df: float = 1.0):
+        self.ngram_range = ngram_range
+        self.iris = list(annotation_index.keys())
+        self.vocab = dict()
+
+        label_class = array("i")
+        indptr, indices = array("q", [0]), array("i")
+        for class_id, iri in enumerate(self.iris):
+            for label in annotation_index[iri]:
+                indices.extend(self.vocab.setdefault(g, len(self.vocab)) for g in char_ngrams(label, ngram_range))
+                indptr.append(len(indices))
+                label_class.append(class_id)
+        self.label_class = np.frombuffer(label_class, dtype=np.int32)
+
+        counts = self._csr(indptr, indices, len(self.vocab))
+        num_labels = counts.shape[0]
+        df = np.bincount(counts.indices, minlength=len(self.vocab))
+        self.idf = (np.log((1 + num_labels) / (1 + df)) + 1).astype(np.float32)
+        # like a stop-word list, n-grams shared by too many labels (e.g., " ca", "ine ") can be dropped to keep
+        # the chunk products sparse on large ontologies, at the risk of labels made only of such n-grams
+        self.idf[df > max_df * num_labels] = 0.0
+        # (vocab x labels) so that a chunk of source labels is scored with a single sparse product
+        self.matrix_t = self._tfidf(counts).T.tocsr()
+
+    @staticmethod
+    def _csr(indptr, indices, num_cols):
+        indices = np.frombuffer(indices, dtype=np.int32)
+        data = np.ones(len(indices), dtype=np.float32)
+        indptr = np.frombuffer(indptr, dtype=np.int64)
+        counts = sp.csr_matrix((data, indices, indptr), shape=(len(indptr) - 1, num_cols))
+        counts.sum_duplicates()
+        return counts
+
+    def _tfidf(self, counts):
+        counts.data = (1 + np.log(counts.data)) * self.idf[counts.indices]
+        norms = np.sqrt(np.asarray(counts.multiply(counts).sum(axis=1)).ravel())
+        norms[norms == 0] = 1.0
+        counts.eliminate_zeros()
+        return sp.diags(1 / norms).dot(counts).tocsr()
+
+    def transform(self, labels: List[str]):
+        """TF-IDF vectors of (source) labels; n-grams unseen in the target labels are ignored."""
+        indptr, indices = array("q", [0]), array("i")
+        for label in labels:
+            indices.extend(g for g in map(self.vocab.get, char_ngrams(label, self.ngram_range)) if g is not None)
+            indptr.append(len(indices))
+        return self._tfidf(self._csr(indptr, indices, len(self.vocab)))
+
+    def top_k(self, classes_labels: List[List[str]], k: int):
+        """Ids and scores of the `k` best target classes for each entry of a chunk of source classes.
+
+        Each source class's rows of the (label x label) similarity matrix are reduced to the best score
+        per target class first; the top-k classes are then selected with `argpartition`, so no step sorts
+        or copies the whole chunk product.
+        """
+        label_indptr = np.concatenate([[0], np.cumsum([len(labels) for labels in classes_labels])])
+        scores = self.transform([label for labels in classes_labels for label in labels]).dot(self.matrix_t).tocsr()
+
+        results = []
+        for i in range(len(classes_labels)):
+            start, end = scores.indptr[label_indptr[i]], scores.indptr[label_indptr[i + 1]]
+            data, tgt = scores.data[start:end], self.label_class[scores.indices[start:end]]
+            if len(data) == 0:
+                results.append(([], []))
+                continue
+            # best score of each target class over all (source label, target label) pairs
+            order = np.argsort(tgt, kind="stable")
+            tgt, data = tgt[order], data[order]
+            firsts = np.flatnonzero(np.concatenate([[True], tgt[1:] != tgt[:-1]]))
+            classes, class_scores = tgt[firsts], np.maximum.reduceat(data, firsts)
+            if len(classes) > k:
+                best = np.argpartition(-class_scores, k - 1)[:k]
+                classes, class_scores = classes[best], class_scores[best]
+            order = np.lexsort((classes, -class_scores))
+            results.append((classes[order].tolist(), class_scores[order].tolist()))
+        return results
+
+
+def generate_candidates(
+    src_annotation_index: dict,
+    tgt_annotation_index: dict,
+    top_k: int = 100,
+    reference: Optional[dict] = None,
+    src_iris: Optional[Iterable[str]] = None,
+    chunk_size: int = 256,
+    ngram_range: Tuple[int, int] = (3, 4),
+    max_df: float = 1.0,
+    index: Optional[LexicalIndex] = None,
+    skipped: Optional[list] = None,
+):
+    """Stream `(src_class_iri, tgt_class_iri, tgt_cands)` rows for every source class (or those in `src_iris`).
+
+    The reference target is looked up in `reference`, e.g., `dict(read_reference_pairs(ref_file))` (`"UnMatched"`
+    if absent), so that the rows can be fed to `run_experiments` directly or stored with `write_candidates_binary`.
+    Source classes are scored `chunk_size` at a time, which bounds the size of the similarity matrix kept in
+    memory; a `max_df` below 1 (dropping the n-grams of more than that fraction of the target labels) makes it
+    sparser still. Source classes without any candidate (no labels, or no n-gram shared with a target label) are
+    not yielded but appended to `skipped` if given.
+    """
+    index = index if index is not None else LexicalIndex(tgt_annotation_index, ngram_range, max_df)
+    reference = reference if reference is not None else dict()
+    src_iris = src_iris if src_iris is not None else src_annotation_index.keys()
+    skipped = skipped if skipped is not None else []
+    labelled_iris = []
+    for iri in src_iris:
+        (labelled_iris if src_annotation_index.get(iri) else skipped).append(iri)
+
+    for start in range(0, len(labelled_iris), chunk_size):
+        chunk = labelled_iris[start : start + chunk_size]
+        results = index.top_k([list(src_annotation_index[iri]) for iri in chunk], top_k)
+        for src_class_iri, (tgt_ids, _) in zip(chunk, results):
+            if tgt_ids:
+                tgt_cands = [index.iris[j] for j in tgt_ids]
+                yield src_class_iri, reference.get(src_class_iri, "UnMatched"), tgt_cands
+            else:
+                skipped.append(src_class_iri)
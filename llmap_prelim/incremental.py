@@ -0,0 +1,107 @@
+#    Copyright 2023 Yuan He
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from typing import Iterable, Optional, Union, TYPE_CHECKING
+import os
+from pandas import DataFrame
+from .candidates import iter_candidates
+from .journal import load_results, compact_results
+from .processing import get_context_labels
+from .snapshot import OntologySnapshot
+
+if TYPE_CHECKING:
+    from deeponto.onto import Ontology
+
+
+def class_signature(
+    ontology: Union["Ontology", OntologySnapshot],
+    annotation_index: dict,
+    hierarchy_index: dict,
+    class_iri: str,
+    with_structural_context: bool = False,
+):
+    """Everything of a class that goes into a prompt: its labels and (optionally) its parent and child labels."""
+    labels = frozenset(annotation_index.get(class_iri, ()))
+    if not with_structural_context or class_iri not in annotation_index:
+        return labels
+    parents, children = get_context_labels(ontology, annotation_index, hierarchy_index, class_iri)
+    return labels, frozenset(parents), frozenset(children)
+
+
+class VersionDiff:
+    """Lazily diff the classes of two versions of an ontology, memoising the verdict per class."""
+
+    def __init__(
+        self,
+        old_onto: Union["Ontology", OntologySnapshot],
+        old_annotation_index: dict,
+        new_onto: Union["Ontology", OntologySnapshot],
+        new_annotation_index: dict,
+        with_structural_context: bool = False,
+        old_hierarchy_index: Optional[dict] = None,
+        new_hierarchy_index: Optional[dict] = None,
+    ):
+        self.old = (old_onto, old_annotation_index, old_hierarchy_index if old_hierarchy_index is not None else dict())
+        self.new = (new_onto, new_annotation_index, new_hierarchy_index if new_hierarchy_index is not None else dict())
+        self.with_structural_context = with_structural_context
+        self.verdicts = dict()
+
+    def changed(self, class_iri: str):
+        if class_iri not in self.verdicts:
+            old_signature = class_signature(*self.old, class_iri, self.with_structural_context)
+            new_signature = class_signature(*self.new, class_iri, self.with_structural_context)
+            self.verdicts[class_iri] = old_signature != new_signature
+        return self.verdicts[class_iri]
+
+    def num_changed(self):
+        return sum(self.verdicts.values())
+
+
+def carry_forward_results(
+    prev_result_file: str,
+    result_file: str,
+    test_cands: Union[DataFrame, str, Iterable],
+    src_diff: Optional[VersionDiff] = None,
+    tgt_diff: Optional[VersionDiff] = None,
+):
+    """Seed `result_file` with the results of `prev_result_file` whose prompts are unchanged.
+
+    A `(src, cand)` pair is carried forward if it is still a candidate and neither class has changed
+    (no diff means that side of the alignment is unchanged); `run_experiments` on `result_file` then
+    only scores the remaining pairs. Results already in `result_file` (e.g., of an interrupted
+    incremental run) are kept.
+    """
+    assert os.path.abspath(prev_result_file) != os.path.abspath(result_file), "write the re-alignment to a new file"
+    prev_result_dict = load_results(prev_result_file)
+    result_dict = load_results(result_file)
+
+    num_pairs, num_carried = 0, 0
+    for src_class_iri, tgt_class_iri, tgt_cands in iter_candidates(test_cands):
+        num_pairs += len(tgt_cands)
+        prev_preds = prev_result_dict.get((src_class_iri, tgt_class_iri))
+        if not prev_preds or (src_diff is not None and src_diff.changed(src_class_iri)):
+            continue
+        for tgt_cand_iri in tgt_cands:
+            if tgt_cand_iri in prev_preds and not (tgt_diff is not None and tgt_diff.changed(tgt_cand_iri)):
+                preds = result_dict.setdefault((src_class_iri, tgt_class_iri), dict())
+                preds.setdefault(tgt_cand_iri, prev_preds[tgt_cand_iri])
+                num_carried += 1
+    compact_results(result_file, result_dict)
+
+    return {
+        "pairs": num_pairs,
+        "carried_pairs": num_carried,
+        "changed_src_classes": src_diff.num_changed() if src_diff is not None else 0,
+        "changed_tgt_classes": tgt_diff.num_changed() if tgt_diff is not None else 0,
+    }
@@ -0,0 +1,117 @@
+#    Copyright 2023 Yuan He
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from typing import Optional
+from collections import defaultdict
+import os
+import json
+from deeponto.utils import load_file, save_file
+
+
+def journal_file_of(result_file: str):
+    return f"{result_file}.journal"
+
+
+def jsonable(value):
+    # numpy scalars (e.g., flan-t5 scores) are not JSON serialisable
+    if hasattr(value, "item"):
+        return value.item()
+    if isinstance(value, (list, tuple)):
+        return [jsonable(v) for v in value]
+    if isinstance(value, dict):
+        return {k: jsonable(v) for k, v in value.items()}
+    return value
+
+
+class ResultJournal:
+    """Append-only journal with one JSON record per scored `(src_ref, tgt_ref, tgt_cand)` triple.
+
+    Records are buffered and written in batches; each flush is followed by `fsync` so that a crash
+    loses at most the unflushed records and never corrupts those already written.
+    """
+
+    def __init__(self, journal_file: str, flush_every: int = 100):
+        self.journal_file = journal_file
+        self.flush_every = flush_every
+        self.buffer = []
+        self._drop_partial_record()
+        self.file = open(journal_file, "a", encoding="utf-8")
+
+    def _drop_partial_record(self):
+        # a crash during writing can leave an incomplete last line which new records must not extend
+        if not os.path.exists(self.journal_file):
+            return
+        with open(self.journal_file, "rb+") as f:
+            content = f.read()
+            if content and not content.endswith(b"\n"):
+                f.truncate(content.rfind(b"\n") + 1)
+
+    def append(self, src_ref: str, tgt_ref: str, tgt_cand: str, value: tuple):
+        self.buffer.append(json.dumps([src_ref, tgt_ref, tgt_cand, jsonable(value)]))
+        if len(self.buffer) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.file.write("\n".join(self.buffer) + "\n")
+            self.buffer = []
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+    @staticmethod
+    def replay(journal_file: str, result_dict: Optional[dict] = None):
+        """Apply the records of a journal on top of `result_dict` (a new one if not given)."""
+        if result_dict is None:
+            result_dict = defaultdict(dict)
+        if not os.path.exists(journal_file):
+            return result_dict
+        with open(journal_file, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    src_ref, tgt_ref, tgt_cand, value = json.loads(line)
+                except ValueError:
+                    # a partially written last record from an interrupted run
+                    break
+                result_dict[src_ref, tgt_ref][tgt_cand] = tuple(value)
+        return result_dict
+
+
+def load_results(result_file: str):
+    """Load the compacted results (if any) and replay the journal of an unfinished run on top."""
+    try:
+        result_dict = load_file(result_file)
+    except:
+        result_dict = defaultdict(dict)
+    return ResultJournal.replay(journal_file_of(result_file), result_dict)
+
+
+def compact_results(result_file: str, result_dict: Optional[dict] = None):
+    """Write the results into `result_file` (the dict consumed by `eval.py`) and drop the journal.
+
+    The result file is replaced atomically so that the previous copy survives a crash during writing.
+    """
+    if result_dict is None:
+        result_dict = load_results(result_file)
+    base, ext = os.path.splitext(result_file)
+    tmp_file = f"{base}.tmp{ext}"
+    save_file(result_dict, tmp_file)
+    os.replace(tmp_file, result_file)
+    journal_file = journal_file_of(result_file)
+    if os.path.exists(journal_file):
+        os.remove(journal_file)
+    return result_dict
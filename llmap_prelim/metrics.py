@@ -0,0 +1,104 @@
+#    Copyright 2023 Yuan He
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from typing import Optional
+from collections import defaultdict
+import json
+import time
+import numpy as np
+from .journal import jsonable
+
+STAGES = ["context", "cascade", "prompt", "model", "persist"]
+
+# USD per 1k tokens (gpt-3.5-turbo); local models cost nothing per call
+GPT_PRICES = {"prompt": 0.0015, "completion": 0.002}
+
+
+class Stopwatch:
+    """Context manager measuring the elapsed wall time of its block in seconds."""
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        self.elapsed = 0.0
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.perf_counter() - self.start
+
+
+class RunMetrics:
+    """Per-pair stage timings of `run_experiments`, written to a JSONL file, and an end-of-run summary.
+
+    The stages are context lookup, lexical pre-filtering, prompt construction, model call and result
+    persistence; the time of a batched or concurrent call is shared among its pairs.
+    """
+
+    def __init__(self, metrics_file: Optional[str] = None, prices: dict = GPT_PRICES):
+        self.metrics_file = metrics_file
+        self.prices = prices
+        self.file = open(metrics_file, "a", encoding="utf-8") if metrics_file else None
+        self.latencies = defaultdict(list)
+        self.num_pairs = 0
+        self.num_pruned = 0
+        self.prompt_tokens = 0
+        self.start = time.perf_counter()
+
+    def log_pairs(self, src_class_iri: str, tgt_class_iri: str, pair_metrics: dict):
+        """Log the metrics of the scored candidates of one source class."""
+        lines = []
+        for tgt_cand_iri, m in pair_metrics.items():
+            m["total"] = sum(m.get(stage, 0.0) for stage in STAGES)
+            for stage in STAGES + ["total"]:
+                if stage in m:
+                    self.latencies[stage].append(m[stage])
+            self.num_pairs += 1
+            self.num_pruned += bool(m.get("pruned"))
+            self.prompt_tokens += m.get("prompt_tokens", 0)
+            if self.file:
+                lines.append(json.dumps(dict(jsonable(m), src=src_class_iri, ref=tgt_class_iri, cand=tgt_cand_iri)))
+        if self.file and lines:
+            self.file.write("\n".join(lines) + "\n")
+            self.file.flush()
+
+    def summary(self, predictor=None):
+        """Latency percentiles per stage, throughput and (for GPT) the estimated API cost."""
+        elapsed = time.perf_counter() - self.start
+        summary = {
+            "pairs": self.num_pairs,
+            "pruned_pairs": self.num_pruned,
+            "elapsed_seconds": elapsed,
+            "pairs_per_second": self.num_pairs / elapsed if elapsed else 0.0,
+            "counted_prompt_tokens": self.prompt_tokens,
+        }
+        for stage, latencies in self.latencies.items():
+            summary[f"{stage}_p50_seconds"] = float(np.percentile(latencies, 50))
+            summary[f"{stage}_p95_seconds"] = float(np.percentile(latencies, 95))
+        if predictor is not None:
+            summary.update(predictor.stats)
+            if predictor.cache is not None:
+                summary.update({f"cache_{k}": v for k, v in predictor.cache.stats().items()})
+            # an escalating predictor reports the token counts of its (gpt) remote model
+            if predictor.model_type in ["gpt", "escalate"]:
+                summary["estimated_cost_usd"] = (
+                    predictor.stats["prompt_tokens"] / 1000 * self.prices["prompt"]
+                    + predictor.stats["completion_tokens"] / 1000 * self.prices["completion"]
+                )
+        return summary
+
+    def close(self, predictor=None):
+        summary = self.summary(predictor)
+        if self.file:
+            self.file.write(json.dumps(dict(jsonable(summary), summary=True)) + "\n")
+            self.file.close()
+        return summary
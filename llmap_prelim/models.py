@@ -12,77 +12,246 @@
 #    See the License for the specific language governing permissions and
 #   limitations under the License.
 
-from typing import Optional, List
+from typing import Optional, List, Tuple, TYPE_CHECKING
+from collections import Counter
+import hashlib
+import itertools
+import threading
 import time
-import random
 import numpy as np
 import openai
+import torch
 
 # set key before use
 from transformers import T5Tokenizer, T5ForConditionalGeneration
-from deeponto.align.bertmap import BERTMapPipeline
+from .dispatch import GPTDispatcher, call_with_retries
+from .cache import PromptCache
+from .cascade import edit_similarity_scores
+
+if TYPE_CHECKING:
+    from deeponto.align.bertmap import BERTMapPipeline
 
 
 class LMPredictor:
-    def __init__(self, choice: str, openai_key: Optional[str] = None, bertmap_model: Optional[BERTMapPipeline] = None):
-        # choices: gpt, flan-t5, bertmap
-        assert choice in ["gpt", "flan-t5", "bertmap"]
+    def __init__(
+        self,
+        choice: str,
+        openai_key: Optional[str] = None,
+        bertmap_model: Optional["BERTMapPipeline"] = None,
+        openai_api_base: Optional[str] = None,
+        max_in_flight: int = 8,
+        requests_per_minute: Optional[int] = 3500,
+        tokens_per_minute: Optional[int] = 90000,
+        request_timeout: Optional[float] = 60,
+        cache: Optional[PromptCache] = None,
+        t5_model_name: Optional[str] = None,
+        quantize: bool = True,
+        num_threads: Optional[int] = None,
+        stub_latency: float = 0.0,
+        max_synonym_scores: int = 1000000,
+    ):
+        # choices: gpt, flan-t5, flan-t5-cpu, bertmap, stub (deterministic, offline; for benchmarking)
+        assert choice in ["gpt", "flan-t5", "flan-t5-cpu", "bertmap", "stub"]
         self.model_type = choice
+        # request, token and retry counters (updated from the dispatcher threads as well)
+        self.stats = Counter()
+        self.stats_lock = threading.Lock()
+        # prompt length limit (in `count_tokens` units) for prompts that grow with the input, e.g., listwise ones
+        self.max_prompt_tokens = None
         if choice == "gpt":
             assert openai_key
             openai.api_key = openai_key
+            # an alternative endpoint, e.g., a local stub server for testing
+            if openai_api_base:
+                openai.api_base = openai_api_base
+            self.request_timeout = request_timeout
+            self.model_identity = {"model": "gpt-3.5-turbo", "max_tokens": 512, "temperature": 0}
+            # the 4k context window minus the tokens reserved for the answer
+            self.max_prompt_tokens = 4096 - 512
             self.predict = self.gpt_predict
+            self.dispatcher = GPTDispatcher(
+                self.gpt_request,
+                max_in_flight=max_in_flight,
+                requests_per_minute=requests_per_minute,
+                tokens_per_minute=tokens_per_minute,
+                on_retry=self.count_retry,
+            )
+            self.predict_stream = self.dispatcher.imap_unordered
+            self.complete = self.gpt_complete
         elif choice == "flan-t5":
-            self.tokenizer = T5Tokenizer.from_pretrained("google/flan-t5-xxl")
-            self.t5 = T5ForConditionalGeneration.from_pretrained("google/flan-t5-xxl", device_map="auto")
+            t5_model_name = t5_model_name or "google/flan-t5-xxl"
+            self.tokenizer = T5Tokenizer.from_pretrained(t5_model_name)
+            self.t5 = T5ForConditionalGeneration.from_pretrained(t5_model_name, device_map="auto")
+            self.device = "cuda"
+            self.model_identity = {"model": t5_model_name}
+            self.max_prompt_tokens = 512
+            self.predict = self.flan_t5_predict
+            self.predict_batch = self.flan_t5_predict_batch
+            self.complete = self.flan_t5_complete
+        elif choice == "flan-t5-cpu":
+            # CPU-only nodes: a smaller model size (google/flan-t5-large by default) and int8 dynamic
+            # quantization of the linear layers keep the memory footprint and per-pair latency down
+            t5_model_name = t5_model_name or "google/flan-t5-large"
+            if num_threads:
+                torch.set_num_threads(num_threads)
+            self.tokenizer = T5Tokenizer.from_pretrained(t5_model_name)
+            self.t5 = T5ForConditionalGeneration.from_pretrained(t5_model_name).eval()
+            if quantize:
+                self.t5 = torch.quantization.quantize_dynamic(self.t5, {torch.nn.Linear}, dtype=torch.qint8)
+            self.device = "cpu"
+            self.model_identity = {"model": t5_model_name, "quantized": quantize}
+            self.max_prompt_tokens = 512
             self.predict = self.flan_t5_predict
+            self.predict_batch = self.flan_t5_predict_batch
+            self.complete = self.flan_t5_complete
+        elif choice == "stub":
+            self.stub_latency = stub_latency
+            self.model_identity = {"model": "stub"}
+            self.predict = self.stub_predict
+            self.complete = self.stub_complete
         elif choice == "bertmap":
             # need to fine-tune first
             self.bertmap = bertmap_model
+            self.model_identity = {"model": "bertmap", "path": getattr(bertmap_model, "output_path", None)}
             self.predict = self.bertmap_predict
+            self.predict_bertmap_batch = self.bertmap_predict_batch
+            # synonym scores of label pairs seen before (labels recur across source classes), dropped
+            # once more than `max_synonym_scores` pairs are kept
+            self.synonym_scores = dict()
+            self.max_synonym_scores = max_synonym_scores
+
+        # every backend consults the shared prompt/response cache first
+        self.cache = cache
+        if cache is not None:
+            self.predict = self.cached_predict(self.predict)
+            if hasattr(self, "predict_batch"):
+                self.predict_batch = self.cached_predict_batch(self.predict_batch)
+            if hasattr(self, "predict_stream"):
+                self.predict_stream = self.cached_predict_stream(self.predict_stream)
+            if hasattr(self, "complete"):
+                self.complete = self.cached_predict(self.complete, method="complete")
+            if hasattr(self, "predict_bertmap_batch"):
+                self.predict_bertmap_batch = self.cached_predict_bertmap_batch(self.predict_bertmap_batch)
+
+    def add_stats(self, **counts):
+        with self.stats_lock:
+            self.stats.update(counts)
+
+    def count_retry(self, backoff_in_seconds: float):
+        self.add_stats(retries=1, backoff_seconds=backoff_in_seconds)
+
+    def count_tokens(self, input_text: str):
+        """Number of prompt tokens (estimated from the characters for gpt)."""
+        if self.model_type == "gpt":
+            return GPTDispatcher.estimate_tokens(input_text)
+        if hasattr(self, "tokenizer"):
+            return len(self.tokenizer(input_text).input_ids)
+        return 0
+
+    def cache_key(self, method: str, model_input):
+        # single and batched flan-t5 predictions decode differently, hence the method name
+        return self.cache.make_key(dict(self.model_identity, method=method), model_input)
+
+    def cached_predict(self, predict_fn, method: str = "predict"):
+        def predict(*model_input):
+            key = self.cache_key(method, model_input)
+            result = self.cache.get(key)
+            if result is None:
+                result = predict_fn(*model_input)
+                self.cache.put(key, result)
+            return result
+
+        return predict
+
+    def cached_predict_batch(self, predict_batch_fn):
+        def predict_batch(input_texts: List[str], **kwargs):
+            keys = [self.cache_key("predict_batch", input_text) for input_text in input_texts]
+            results = [self.cache.get(key) for key in keys]
+            missed = [i for i, result in enumerate(results) if result is None]
+            if missed:
+                for i, result in zip(missed, predict_batch_fn([input_texts[i] for i in missed], **kwargs)):
+                    self.cache.put(keys[i], result)
+                    results[i] = result
+            return results
+
+        return predict_batch
+
+    def cached_predict_stream(self, predict_stream_fn):
+        def predict_stream(keyed_texts):
+            missed = []
+            for key, input_text in keyed_texts:
+                result = self.cache.get(self.cache_key("predict", input_text))
+                if result is None:
+                    missed.append((key, input_text))
+                else:
+                    yield key, result, 0.0
+            texts = dict(missed)
+            for key, result, seconds in predict_stream_fn(missed):
+                self.cache.put(self.cache_key("predict", texts[key]), result)
+                yield key, result, seconds
+
+        return predict_stream
+
+    def cached_predict_bertmap_batch(self, predict_bertmap_batch_fn):
+        def predict_bertmap_batch(src_class_labels, tgt_cands_labels: list):
+            # the same keys as `predict` on a single (source, target) label pair
+            keys = [self.cache_key("predict", (src_class_labels, tgt_labels)) for tgt_labels in tgt_cands_labels]
+            results = [self.cache.get(key) for key in keys]
+            missed = [i for i, result in enumerate(results) if result is None]
+            if missed:
+                missed_results = predict_bertmap_batch_fn(src_class_labels, [tgt_cands_labels[i] for i in missed])
+                for i, result in zip(missed, missed_results):
+                    self.cache.put(keys[i], result)
+                    results[i] = result
+            return results
+
+        return predict_bertmap_batch
+
+    def gpt_request(self, input_text: str):
+        """A single GPT request; connection and rate limit errors are left to the caller."""
+        completion = openai.ChatCompletion.create(
+            model="gpt-3.5-turbo",
+            messages=[{"role": "user", "content": input_text}],
+            max_tokens=512,
+            temperature=0,
+            request_timeout=self.request_timeout,
+        )
+        self.add_stats(
+            requests=1,
+            prompt_tokens=completion.usage.prompt_tokens,
+            completion_tokens=completion.usage.completion_tokens,
+        )
+        answer = completion.choices[0].message.content.strip()
+        score = float("Yes" in answer or "yes" in answer or "are identical" in answer)
+
+        # completion = openai.Completion.create(
+        #     model="text-davinci-003",
+        #     prompt=input_text,
+        #     max_tokens=3,
+        #     temperature=0,
+        #     logprobs=1,
+        # )
+        # answer = completion["choices"][0].text.strip()
+        # logprobs = completion["choices"][0].logprobs
+        # score = 0.0
+        # for tk, tk_score in zip(logprobs.tokens, logprobs.token_logprobs):
+        #     if "Yes" == tk:
+        #         score = np.exp(tk_score)
+        #         break
+        #     elif "No" == tk:
+        #         score = -np.exp(tk_score)  # assigning negative score
+        #         break
+
+        return answer, score
 
     def gpt_predict(self, input_text: str, max_retries: int = 5):
         """GPT prediction function with exponential waiting time."""
-        retries = 0
-        while True:
-            try:
-                
-                completion = openai.ChatCompletion.create(
-                    model="gpt-3.5-turbo",
-                    messages=[{"role": "user", "content": input_text}],
-                    max_tokens=512,
-                    temperature=0,
-                )
-                answer = completion.choices[0].message.content.strip()
-                score = float("Yes" in answer or "yes" in answer or "are identical" in answer)
-                
-                # completion = openai.Completion.create(
-                #     model="text-davinci-003",
-                #     prompt=input_text,
-                #     max_tokens=3,
-                #     temperature=0,
-                #     logprobs=1,
-                # )
-                # answer = completion["choices"][0].text.strip()
-                # logprobs = completion["choices"][0].logprobs
-                # score = 0.0
-                # for tk, tk_score in zip(logprobs.tokens, logprobs.token_logprobs):
-                #     if "Yes" == tk:
-                #         score = np.exp(tk_score)
-                #         break
-                #     elif "No" == tk:
-                #         score = -np.exp(tk_score)  # assigning negative score
-                #         break
-                break
-            except:
-                if retries == max_retries:
-                    raise Exception("Retries exceeded")
-                backoff_in_seconds = 1
-                sleep = backoff_in_seconds * 2**retries + random.uniform(0, 1)
-                time.sleep(sleep)
-                retries += 1
+        return call_with_retries(self.gpt_request, input_text, max_retries=max_retries, on_retry=self.count_retry)
 
-        return answer, score
+    def gpt_complete(self, input_text: str):
+        """Free-text GPT answer (e.g., for listwise prompts)."""
+        answer, _ = self.gpt_predict(input_text)
+        return answer
 
     def flan_t5_predict(self, input_text: str):
         """Flan-t5 prediction function (prediction scores are available)."""
@@ -90,7 +259,7 @@ class LMPredictor:
         assert self.tokenizer
         assert self.t5
 
-        input_ids = self.tokenizer(input_text, return_tensors="pt").input_ids.to("cuda")
+        input_ids = self.tokenizer(input_text, return_tensors="pt").input_ids.to(self.device)
         outputs = self.t5.generate(input_ids, max_new_tokens=3, return_dict_in_generate=True, output_scores=True)
         transition_scores = self.t5.compute_transition_scores(outputs.sequences, outputs.scores, normalize_logits=True)
         input_length = 1 if self.t5.config.is_encoder_decoder else input_ids.shape[1]
@@ -119,6 +288,53 @@ class LMPredictor:
 
         return answer, score
 
+    def flan_t5_complete(self, input_text: str, max_new_tokens: int = 32):
+        """Free-text Flan-t5 answer (e.g., for listwise prompts)."""
+
+        assert self.tokenizer
+        assert self.t5
+
+        input_ids = self.tokenizer(input_text, return_tensors="pt").input_ids.to(self.device)
+        outputs = self.t5.generate(input_ids, max_new_tokens=max_new_tokens)
+        return self.tokenizer.decode(outputs[0], skip_special_tokens=True).strip()
+
+    def flan_t5_predict_batch(self, input_texts: List[str], batch_size: int = 16):
+        """Batched Flan-t5 prediction function.
+
+        Prompts are grouped into length-bucketed batches and the "Yes"/"No" probabilities are read
+        from the logits of the first decoding step, so each batch costs a single forward pass.
+        """
+
+        assert self.tokenizer
+        assert self.t5
+
+        yes_id = self.tokenizer("Yes", add_special_tokens=False).input_ids[0]
+        no_id = self.tokenizer("No", add_special_tokens=False).input_ids[0]
+
+        # sort by length so that each batch carries as little padding as possible
+        lengths = [len(ids) for ids in self.tokenizer(input_texts).input_ids]
+        order = sorted(range(len(input_texts)), key=lambda i: lengths[i])
+
+        results = [None] * len(input_texts)
+        for start in range(0, len(order), batch_size):
+            batch_idxs = order[start : start + batch_size]
+            inputs = self.tokenizer(
+                [input_texts[i] for i in batch_idxs], return_tensors="pt", padding=True
+            ).to(self.device)
+            decoder_input_ids = torch.full(
+                (len(batch_idxs), 1), self.t5.config.decoder_start_token_id, dtype=torch.long, device=self.device
+            )
+            with torch.no_grad():
+                logits = self.t5(**inputs, decoder_input_ids=decoder_input_ids).logits[:, 0, :]
+            probs = torch.softmax(logits.float(), dim=-1)[:, [yes_id, no_id]].cpu().numpy()
+            for i, (yes_prob, no_prob) in zip(batch_idxs, probs):
+                if yes_prob >= no_prob:
+                    results[i] = ("Yes", yes_prob)
+                else:
+                    results[i] = ("No", -no_prob)  # assigning negative score
+
+        return results
+
     def bertmap_predict(self, src_class_labels: List[str], tgt_class_labels: List[str]):
 
         bertmap_score = self.bertmap.mapping_predictor.bert_mapping_score(src_class_labels, tgt_class_labels)
@@ -128,3 +344,101 @@ class LMPredictor:
         )
 
         return bertmap_score, bertmaplt_score
+
+    def bertmap_predict_batch(self, src_class_labels: List[str], tgt_cands_labels: List[List[str]]):
+        """Score a source class against all its target candidates at once.
+
+        Unseen label pairs of the whole candidate set go through the BERT synonym classifier in batches of
+        the mapping predictor's `batch_size_for_prediction`, and the BERTMapLt scores are computed in one
+        vectorised pass.
+        """
+
+        if len(self.synonym_scores) > self.max_synonym_scores:
+            self.synonym_scores.clear()
+        label_pairs = [list(itertools.product(src_class_labels, tgt_labels)) for tgt_labels in tgt_cands_labels]
+        unseen = list({p for pairs in label_pairs for p in pairs if p not in self.synonym_scores})
+        mapping_predictor = self.bertmap.mapping_predictor
+        batch_size = getattr(mapping_predictor, "batch_size_for_prediction", None) or 128
+        for start in range(0, len(unseen), batch_size):
+            batch = unseen[start : start + batch_size]
+            scores = mapping_predictor.bert_synonym_classifier.predict(batch)
+            self.synonym_scores.update(zip(batch, np.asarray(scores.cpu()).reshape(-1).tolist()))
+        bertmap_scores = [float(np.mean([self.synonym_scores[p] for p in pairs])) for pairs in label_pairs]
+        # the bertmaplt scores
+        bertmaplt_scores = edit_similarity_scores(src_class_labels, tgt_cands_labels)
+
+        return list(zip(bertmap_scores, bertmaplt_scores))
+
+    def stub_predict(self, input_text: str):
+        """Deterministic stand-in for a model call, with an optional fixed latency."""
+        if self.stub_latency:
+            time.sleep(self.stub_latency)
+        h = int(hashlib.md5(input_text.encode("utf-8")).hexdigest()[:8], 16) / 0xFFFFFFFF
+        return ("Yes", h) if h >= 0.5 else ("No", -h)
+
+    def stub_complete(self, input_text: str):
+        answer, score = self.stub_predict(input_text)
+        return "1" if answer == "Yes" else "None"
+
+
+class EscalatingPredictor:
+    """Confidence-gated escalation from a cheap local predictor (e.g., flan-t5) to an expensive one (e.g., gpt).
+
+    Every prompt is scored locally; only those whose signed local score ("Yes" = +p, "No" = -p) falls
+    strictly within `uncertainty_band` are sent to the remote predictor, whose answer then decides. The
+    result is `(answer, score, {"local": (answer, score), "remote": (answer, score) or None})` where the
+    score of an escalated pair averages the local score and the signed remote score, so that it keeps the
+    sign of the remote answer.
+    """
+
+    def __init__(self, local: LMPredictor, remote: LMPredictor, uncertainty_band: Tuple[float, float] = (-0.8, 0.8)):
+        assert local.model_type != "bertmap" and remote.model_type != "bertmap"
+        self.model_type = "escalate"
+        self.local = local
+        self.remote = remote
+        self.uncertainty_band = uncertainty_band
+        self.cache = local.cache if local.cache is not None else remote.cache
+        self.escalation_stats = Counter()
+
+    @property
+    def stats(self):
+        # the remote counters come unprefixed so that the API cost is estimated as for a gpt run
+        stats = Counter(self.remote.stats)
+        stats.update({f"local_{k}": v for k, v in self.local.stats.items()})
+        stats.update(self.escalation_stats)
+        return stats
+
+    def count_tokens(self, input_text: str):
+        # prompt budgets are bounded by the (smaller) window of the local model
+        return self.local.count_tokens(input_text)
+
+    def is_uncertain(self, score: float):
+        low, high = self.uncertainty_band
+        return low < score < high
+
+    def combine(self, local_result: tuple, remote_result: Optional[tuple]):
+        if remote_result is None:
+            return local_result[0], local_result[1], {"local": local_result, "remote": None}
+        remote_answer, remote_score = remote_result
+        signed_remote_score = remote_score if remote_score > 0 else -1.0
+        score = (float(local_result[1]) + signed_remote_score) / 2
+        return remote_answer, score, {"local": local_result, "remote": remote_result}
+
+    def predict(self, input_text: str):
+        return self.predict_batch([input_text])[0]
+
+    def predict_batch(self, input_texts: List[str], batch_size: int = 16):
+        if hasattr(self.local, "predict_batch"):
+            local_results = self.local.predict_batch(input_texts, batch_size=batch_size)
+        else:
+            local_results = [self.local.predict(input_text) for input_text in input_texts]
+
+        escalated = [(i, input_texts[i]) for i, (_, score) in enumerate(local_results) if self.is_uncertain(score)]
+        remote_results = dict()
+        if escalated and hasattr(self.remote, "predict_stream"):
+            remote_results.update((i, result) for i, result, _ in self.remote.predict_stream(escalated))
+        else:
+            remote_results.update((i, self.remote.predict(input_text)) for i, input_text in escalated)
+        self.escalation_stats.update(local_only=len(input_texts) - len(escalated), escalated=len(escalated))
+
+        return [self.combine(local_result, remote_results.get(i)) for i, local_result in enumerate(local_results)]
@@ -0,0 +1,110 @@
+#    Copyright 2023 Yuan He
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from typing import Callable, Iterable
+import queue
+import threading
+
+# sentinel closing a queue
+_DONE = object()
+
+
+class _Failure:
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+def _put(q: queue.Queue, item, stop: threading.Event):
+    # a blocking put that gives up once the consumer has stopped (back-pressure without deadlock)
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def prefetch(items: Iterable, size: int):
+    """Iterate `items` in a background thread, at most `size` items ahead of the consumer.
+
+    An exception raised while producing is re-raised in the consumer; closing the generator early
+    (e.g., on an error in the consumer) stops the producer after its current item.
+    """
+    q = queue.Queue(maxsize=size)
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for item in items:
+                if not _put(q, item, stop):
+                    return
+        except BaseException as e:
+            _put(q, _Failure(e), stop)
+            return
+        _put(q, _DONE, stop)
+
+    producer = threading.Thread(target=produce, name="prefetch", daemon=True)
+    producer.start()
+    try:
+        while True:
+            item = q.get()
+            if item is _DONE:
+                return
+            if isinstance(item, _Failure):
+                raise item.error
+            yield item
+    finally:
+        stop.set()
+        producer.join()
+
+
+class BackgroundWriter:
+    """Run persistence tasks in submission order on a single background thread.
+
+    The task queue is bounded so that a slow disk throttles the producer of the tasks; `close` waits
+    for every submitted task. A task failure is re-raised on the next `submit` or on `close`.
+    """
+
+    def __init__(self, max_pending: int = 1000):
+        self.tasks = queue.Queue(maxsize=max_pending)
+        self.failure = None
+        self.thread = threading.Thread(target=self._run, name="writer", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            task = self.tasks.get()
+            if task is _DONE:
+                return
+            if self.failure is None:
+                fn, args = task
+                try:
+                    fn(*args)
+                except BaseException as e:
+                    # later tasks are dropped; the results they would persist are still in memory
+                    self.failure = e
+
+    def _raise_failure(self):
+        if self.failure is not None:
+            raise self.failure
+
+    def submit(self, fn: Callable, *args):
+        self._raise_failure()
+        self.tasks.put((fn, args))
+
+    def close(self):
+        self.tasks.put(_DONE)
+        self.thread.join()
+        self._raise_failure()
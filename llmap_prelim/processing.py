@@ -12,12 +12,33 @@
 #    See the License for the specific language governing permissions and
 #   limitations under the License.
 
-from typing import List
-from deeponto.onto import Ontology
-from deeponto.align.bertmap import BERTMapPipeline
+from typing import Callable, List, Optional, Union, TYPE_CHECKING
+import re
+import os
+from deeponto.utils import load_file, save_file
+from .snapshot import OntologySnapshot, load_snapshot, file_hash, snapshot_dir_of
 
+# `deeponto.onto` starts the JVM on import, so it is only imported where a real ontology is needed
+if TYPE_CHECKING:
+    from deeponto.onto import Ontology
 
-def load_ontos(src_onto_file: str, tgt_onto_file: str):
+
+def load_ontos(src_onto_file: str, tgt_onto_file: str, use_snapshot: bool = False):
+    """Load the source and target ontologies with their annotation indexes.
+
+    With `use_snapshot=True`, valid snapshots (see `snapshot.py`) are returned in place of the
+    ontologies so that the JVM is never started; they are written on the first load. The BERTMap
+    config is `None` when both ontologies are served from snapshots.
+    """
+
+    if use_snapshot:
+        src_snapshot = load_snapshot(src_onto_file)
+        tgt_snapshot = load_snapshot(tgt_onto_file)
+        if src_snapshot and tgt_snapshot:
+            return src_snapshot, tgt_snapshot, src_snapshot.annotation_index, tgt_snapshot.annotation_index, None
+
+    from deeponto.onto import Ontology
+    from deeponto.align.bertmap import BERTMapPipeline
 
     # load ontologies
     src_onto = Ontology(src_onto_file)
@@ -30,6 +51,13 @@ def load_ontos(src_onto_file: str, tgt_onto_file: str):
     src_annotation_index, _ = src_onto.build_annotation_index(config.annotation_property_iris)
     tgt_annotation_index, _ = tgt_onto.build_annotation_index(config.annotation_property_iris)
 
+    if use_snapshot:
+        for onto_file, onto, annotation_index in [
+            (src_onto_file, src_onto, src_annotation_index),
+            (tgt_onto_file, tgt_onto, tgt_annotation_index),
+        ]:
+            OntologySnapshot.build(onto, annotation_index, snapshot_dir_of(onto_file), file_hash(onto_file))
+
     return src_onto, tgt_onto, src_annotation_index, tgt_annotation_index, config
 
 
@@ -42,30 +70,108 @@ def truncate_labels(labels, cut_off: int = 3):
     return labels[:cut_off]
 
 
-def get_parent_labels(ontology: Ontology, annotation_index: dict, class_iri: str):
-    """Get the parent concepts of a given concept."""
+def get_parent_iris(ontology: Union["Ontology", OntologySnapshot], class_iri: str):
+    """Get the IRIs of the asserted named parents of a given concept."""
+    if isinstance(ontology, OntologySnapshot):
+        return ontology.get_parent_iris(class_iri)
     concept = ontology.get_owl_object_from_iri(class_iri)
-    concept_parents = ontology.get_asserted_parents(concept, named_only=True)
+    return [str(p.getIRI()) for p in ontology.get_asserted_parents(concept, named_only=True)]
+
+
+def get_child_iris(ontology: Union["Ontology", OntologySnapshot], class_iri: str):
+    """Get the IRIs of the asserted named children of a given concept."""
+    if isinstance(ontology, OntologySnapshot):
+        return ontology.get_child_iris(class_iri)
+    concept = ontology.get_owl_object_from_iri(class_iri)
+    return [str(c.getIRI()) for c in ontology.get_asserted_children(concept, named_only=True)]
+
+
+def get_parent_labels(ontology: Union["Ontology", OntologySnapshot], annotation_index: dict, class_iri: str):
+    """Get the parent concepts of a given concept."""
     concept_parent_labels = []
-    for p in concept_parents:
+    for p in get_parent_iris(ontology, class_iri):
         # select just one label for each parent concept
-        concept_parent_labels += truncate_labels(annotation_index[str(p.getIRI())], cut_off=1)
+        concept_parent_labels += truncate_labels(annotation_index[p], cut_off=1)
     concept_parent_labels = set(concept_parent_labels)
     return list(concept_parent_labels)
 
 
-def get_child_labels(ontology: Ontology, annotation_index: dict, class_iri: str):
+def get_child_labels(ontology: Union["Ontology", OntologySnapshot], annotation_index: dict, class_iri: str):
     """Get the child concepts of a given concept."""
-    concept = ontology.get_owl_object_from_iri(class_iri)
-    concept_children = ontology.get_asserted_children(concept, named_only=True)
     concept_children_labels = []
-    for c in concept_children:
+    for c in get_child_iris(ontology, class_iri):
         # select just one label for each child concept
-        concept_children_labels += truncate_labels(annotation_index[str(c.getIRI())], cut_off=1)
+        concept_children_labels += truncate_labels(annotation_index[c], cut_off=1)
     concept_children_labels = set(concept_children_labels)
     return list(concept_children_labels)
 
 
+def build_hierarchy_index(ontology: Union["Ontology", OntologySnapshot], annotation_index: dict):
+    """Precompute the structural context of every class: `{class_iri: (parent_labels, child_labels)}`."""
+    hierarchy_index = dict()
+    for class_iri in annotation_index.keys():
+        hierarchy_index[class_iri] = (
+            get_parent_labels(ontology, annotation_index, class_iri),
+            get_child_labels(ontology, annotation_index, class_iri),
+        )
+    return hierarchy_index
+
+
+def hierarchy_index_file_of(onto_file: str):
+    return f"{onto_file}.hierarchy.pkl"
+
+
+def load_hierarchy_index(
+    ontology: Union["Ontology", OntologySnapshot],
+    annotation_index: dict,
+    onto_file: str,
+    owl_hash: Optional[str] = None,
+):
+    """Load the hierarchy index of an OWL file, (re)building and saving it once it is missing or stale.
+
+    Like a snapshot, the index is tied to the SHA-256 of the OWL file so that a new release of the
+    ontology at the same path never reuses the parents and children of the previous one.
+    """
+    if owl_hash is None:
+        owl_hash = ontology.meta["owl_sha256"] if isinstance(ontology, OntologySnapshot) else file_hash(onto_file)
+    index_file = hierarchy_index_file_of(onto_file)
+    if os.path.exists(index_file):
+        saved = load_file(index_file)
+        # an index without a hash (older format) is treated as stale
+        if saved.get("owl_sha256") == owl_hash:
+            return saved["hierarchy_index"]
+    hierarchy_index = build_hierarchy_index(ontology, annotation_index)
+    save_file({"owl_sha256": owl_hash, "hierarchy_index": hierarchy_index}, index_file)
+    return hierarchy_index
+
+
+def get_context_labels(
+    ontology: Union["Ontology", OntologySnapshot], annotation_index: dict, hierarchy_index: dict, class_iri: str
+):
+    """Get the parent and child labels of a given concept from the hierarchy index (filled on a miss)."""
+    if class_iri not in hierarchy_index:
+        hierarchy_index[class_iri] = (
+            get_parent_labels(ontology, annotation_index, class_iri),
+            get_child_labels(ontology, annotation_index, class_iri),
+        )
+    return hierarchy_index[class_iri]
+
+
+NAME_PROMPT_PREFIX = "Given the lists of names associated with two concepts, your task is to determine whether these concepts are identical or not. Consider the following:\n\n"
+NAME_PROMPT_SUFFIX = "Analyze the names provided for each concept and provide a conclusion on whether these two concepts are identical or different (\"Yes\" or \"No\") based on their associated names."
+STRUCTURE_PROMPT_PREFIX = "Given the lists of names and hierarchical relationships associated with two concepts, your task is to determine whether these concepts are identical or not. Please consider the following:\n\n"
+STRUCTURE_PROMPT_SUFFIX = "Analyze the names and the hierarchical information provided for each concept, and provide a conclusion on whether these two concepts are identical or different (\"Yes\" or \"No\") based on their associated names and hierarchical relationships."
+
+CONCEPT_TITLES = [
+    "Source Concept Names",
+    "Target Concept Names",
+    "Parent Concepts of the Source Concept",
+    "Parent Concepts of the Target Concept",
+    "Child Concepts of the Source Concept",
+    "Child Concepts of the Target Concept",
+]
+
+
 def concept_template(title: str, list_of_names: List[str], compact_list: bool):
     
     # compact list better for flan-t5
@@ -73,10 +179,7 @@ def concept_template(title: str, list_of_names: List[str], compact_list: bool):
         return f"{title}: {list_of_names}\n"
 
     # point-by-point list better for chatgpt
-    result = f"{title}:\n"
-    for i, n in enumerate(list_of_names):
-        result += f"- {n}\n"
-    return result
+    return f"{title}:\n" + "".join(f"- {n}\n" for n in list_of_names)
 
 def integrated_template(
     src_concept_labels: list, 
@@ -87,27 +190,189 @@ def integrated_template(
     tgt_child_labels: list = None,
     compact_list: bool = False,
 ):
-    v = concept_template("Source Concept Names", src_concept_labels, compact_list)
+    src_parts = [concept_template("Source Concept Names", src_concept_labels, compact_list)]
+    tgt_parts = [concept_template("Target Concept Names", tgt_concept_labels, compact_list)]
     has_parent_child = False
-    if src_parent_labels:
-        v += concept_template("Parent Concepts of the Source Concept", src_parent_labels, compact_list)
-        has_parent_child = True
-    if src_child_labels:
-        v += concept_template("Child Concepts of the Source Concept", src_child_labels, compact_list)
-        has_parent_child = True
-    v +="\n"
-    v += concept_template("Target Concept Names", tgt_concept_labels, compact_list)
-    if tgt_parent_labels:
-        v += concept_template("Parent Concepts of the Target Concept", tgt_parent_labels, compact_list)
-        has_parent_child = True
-    if tgt_child_labels:
-        v += concept_template("Child Concepts of the Target Concept", tgt_child_labels, compact_list)
-        has_parent_child = True
-    v +="\n"
+    for parts, title, labels in [
+        (src_parts, "Parent Concepts of the Source Concept", src_parent_labels),
+        (src_parts, "Child Concepts of the Source Concept", src_child_labels),
+        (tgt_parts, "Parent Concepts of the Target Concept", tgt_parent_labels),
+        (tgt_parts, "Child Concepts of the Target Concept", tgt_child_labels),
+    ]:
+        if labels:
+            parts.append(concept_template(title, labels, compact_list))
+            has_parent_child = True
     if not has_parent_child:
-        v = "Given the lists of names associated with two concepts, your task is to determine whether these concepts are identical or not. Consider the following:\n\n" + v
-        v += "Analyze the names provided for each concept and provide a conclusion on whether these two concepts are identical or different (\"Yes\" or \"No\") based on their associated names."
+        prefix, suffix = NAME_PROMPT_PREFIX, NAME_PROMPT_SUFFIX
     else:
-        v = "Given the lists of names and hierarchical relationships associated with two concepts, your task is to determine whether these concepts are identical or not. Please consider the following:\n\n" + v
-        v += "Analyze the names and the hierarchical information provided for each concept, and provide a conclusion on whether these two concepts are identical or different (\"Yes\" or \"No\") based on their associated names and hierarchical relationships."
-    return v
+        prefix, suffix = STRUCTURE_PROMPT_PREFIX, STRUCTURE_PROMPT_SUFFIX
+    return "".join([prefix] + src_parts + ["\n"] + tgt_parts + ["\n", suffix])
+
+
+def dedup_labels(labels: List[str]):
+    """Drop near-identical labels (the same words up to case, punctuation and order), keeping the first."""
+    seen, deduped = set(), []
+    for label in labels:
+        key = " ".join(sorted(re.findall(r"\w+", label.lower())))
+        if key not in seen:
+            seen.add(key)
+            deduped.append(label)
+    return deduped
+
+
+def budgeted_template(
+    src_concept_labels: list,
+    tgt_concept_labels: list,
+    src_parent_labels: list = None,
+    tgt_parent_labels: list = None,
+    src_child_labels: list = None,
+    tgt_child_labels: list = None,
+    count_tokens: Callable[[str], int] = None,
+    token_budget: int = 256,
+    max_labels: int = 3,
+    compact_list: bool = False,
+):
+    """Build the `integrated_template` prompt within a token budget of the backend's tokenizer.
+
+    Labels are deduplicated and taken cheapest (in tokens) first. One source and one target name are
+    always kept; the rest of the budget goes round-robin to further names, then to parents, then to
+    children (at most `max_labels` per group). Returns the prompt and its token count.
+    """
+    groups = [
+        dedup_labels(sorted(labels or [], key=lambda x: (count_tokens(x), x)))
+        for labels in [
+            src_concept_labels,
+            tgt_concept_labels,
+            src_parent_labels,
+            tgt_parent_labels,
+            src_child_labels,
+            tgt_child_labels,
+        ]
+    ]
+    selected = [groups[0][:1], groups[1][:1], [], [], [], []]
+
+    def render():
+        # `selected` follows the order of `CONCEPT_TITLES`
+        src_names, tgt_names, src_parents, tgt_parents, src_children, tgt_children = selected
+        return integrated_template(
+            src_names, tgt_names, src_parents, tgt_parents, src_children, tgt_children, compact_list=compact_list
+        )
+
+    # estimate the cost of each further label (plus its section title, plus the longer instructions
+    # once the first hierarchical label comes in) and verify the exact count at the end
+    used = count_tokens(render())
+    structure_cost = count_tokens(STRUCTURE_PROMPT_PREFIX + STRUCTURE_PROMPT_SUFFIX) - count_tokens(
+        NAME_PROMPT_PREFIX + NAME_PROMPT_SUFFIX
+    )
+    added = []
+    for tier in [(0, 1), (2, 3), (4, 5)]:
+        for rank in range(max_labels):
+            for g in tier:
+                if rank >= len(groups[g]) or rank < len(selected[g]):
+                    continue
+                cost = count_tokens(f"- {groups[g][rank]}\n")
+                if not selected[g]:
+                    cost += count_tokens(f"{CONCEPT_TITLES[g]}:\n")
+                if g >= 2 and not any(selected[2:]):
+                    cost += structure_cost
+                if used + cost <= token_budget:
+                    selected[g].append(groups[g][rank])
+                    added.append(g)
+                    used += cost
+
+    prompt = render()
+    num_tokens = count_tokens(prompt)
+    while num_tokens > token_budget and added:
+        selected[added.pop()].pop()
+        prompt = render()
+        num_tokens = count_tokens(prompt)
+    return prompt, num_tokens
+
+
+LISTWISE_PROMPT_PREFIX = "Given the names associated with a source concept and a numbered list of candidate target concepts, your task is to identify the candidates that are identical to the source concept. Consider the following:\n\n"
+LISTWISE_PROMPT_SUFFIX = "Analyze the names provided for each concept and give your conclusion on the last line as \"Answer:\" followed by the numbers of the candidates that are identical to the source concept, separated by commas, or \"Answer: None\" if none of them is."
+
+
+def listwise_template(
+    src_concept_labels: list,
+    tgt_cands_labels: List[list],
+    src_parent_labels: list = None,
+    src_child_labels: list = None,
+    tgt_cands_parent_labels: List[list] = None,
+    tgt_cands_child_labels: List[list] = None,
+    compact_list: bool = False,
+):
+    """Present the source concept and a numbered list of target candidates in a single prompt."""
+    parts = [LISTWISE_PROMPT_PREFIX, concept_template("Source Concept Names", src_concept_labels, compact_list)]
+    if src_parent_labels:
+        parts.append(concept_template("Parent Concepts of the Source Concept", src_parent_labels, compact_list))
+    if src_child_labels:
+        parts.append(concept_template("Child Concepts of the Source Concept", src_child_labels, compact_list))
+    parts.append("\nCandidate Target Concepts:\n")
+    for i, cand_labels in enumerate(tgt_cands_labels):
+        context = []
+        if tgt_cands_parent_labels and tgt_cands_parent_labels[i]:
+            context.append(f"parents: {'; '.join(tgt_cands_parent_labels[i])}")
+        if tgt_cands_child_labels and tgt_cands_child_labels[i]:
+            context.append(f"children: {'; '.join(tgt_cands_child_labels[i])}")
+        context = f" ({'; '.join(context)})" if context else ""
+        parts.append(f"{i + 1}. {'; '.join(cand_labels)}{context}\n")
+    parts += ["\n", LISTWISE_PROMPT_SUFFIX]
+    return "".join(parts)
+
+
+def listwise_chunks(
+    render: Callable[[int, int], str],
+    num_cands: int,
+    count_tokens: Callable[[str], int],
+    max_tokens: Optional[int] = None,
+    max_chunk_size: int = 20,
+):
+    """Split candidates into `(start, end)` chunks whose prompts (`render(start, end)`) fit within `max_tokens`.
+
+    A chunk also holds at most `max_chunk_size` candidates; a single candidate too long for the budget
+    still gets a chunk of its own.
+    """
+    chunks, start = [], 0
+    while start < num_cands:
+        end = min(start + 1, num_cands)
+        while end < min(start + max_chunk_size, num_cands):
+            if max_tokens is not None and count_tokens(render(start, end + 1)) > max_tokens:
+                break
+            end += 1
+        chunks.append((start, end))
+        start = end
+    return chunks
+
+
+# a leading list of candidate numbers such as "2", "2, 5" or "2 and 5"
+LISTWISE_NUMBERS = re.compile(r"\s*(\d+(?:\s*(?:,|;|\band\b)\s*\d+)*)")
+
+
+def parse_listwise_answer(answer: str, num_cands: int):
+    """Map a listwise answer back to the (0-based) indices of the selected candidates.
+
+    Only the numbers listed right after the (last) "Answer:" marker, or at the very start of an answer
+    without the marker, count; numbers inside echoed labels or IRIs and any other answer mean "none".
+    """
+    markers = list(re.finditer(r"answer\s*:", answer, flags=re.IGNORECASE))
+    answer = answer[markers[-1].end() :] if markers else answer
+    match = LISTWISE_NUMBERS.match(answer)
+    if not match:
+        return []
+    selected = []
+    for number in re.findall(r"\d+", match.group(1)):
+        i = int(number) - 1
+        if 0 <= i < num_cands and i not in selected:
+            selected.append(i)
+    return selected
+
+
+def listwise_result(selected: bool, lexical_score: float):
+    """The `(answer, score)` of a listwise candidate; the lexical score breaks ties among equal answers.
+
+    Selected candidates score in [0.5, 1] and the others in [-0.5, 0] (cascade-pruned ones stay below -1).
+    """
+    if selected:
+        return "Yes", (1.0 + lexical_score) / 2
+    return "No", (lexical_score - 1.0) / 2
@@ -0,0 +1,79 @@
+#    Copyright 2023 Yuan He
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from typing import Iterable, Union
+from collections import defaultdict
+import os
+import hashlib
+from pandas import DataFrame
+from .candidates import iter_candidates
+from .journal import load_results, compact_results, journal_file_of
+
+
+def shard_of(src_class_iri: str, num_shards: int):
+    """Deterministic shard of a source class (stable across processes and machines, unlike `hash`)."""
+    digest = hashlib.md5(src_class_iri.encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % num_shards
+
+
+def iter_shard(test_cands: Union[DataFrame, str, Iterable], shard_id: int, num_shards: int):
+    """Stream the candidate rows that belong to a given shard."""
+    assert 0 <= shard_id < num_shards
+    for src_class_iri, tgt_class_iri, tgt_cands in iter_candidates(test_cands):
+        if shard_of(src_class_iri, num_shards) == shard_id:
+            yield src_class_iri, tgt_class_iri, tgt_cands
+
+
+def shard_result_file(result_file: str, shard_id: int, num_shards: int):
+    base, ext = os.path.splitext(result_file)
+    return f"{base}.shard{shard_id}of{num_shards}{ext}"
+
+
+def run_shard(test_cands: Union[DataFrame, str, Iterable], result_file: str, shard_id: int, num_shards: int, **kwargs):
+    """Worker entry point: run the experiments of one shard into its own result file.
+
+    The remaining keyword arguments are passed to `run_experiments`. Shards can run as local
+    processes or on different machines against shared storage; see `merge_shard_results`.
+    """
+    from . import run_experiments
+
+    return run_experiments(
+        test_cands=iter_shard(test_cands, shard_id, num_shards),
+        result_file=shard_result_file(result_file, shard_id, num_shards),
+        **kwargs,
+    )
+
+
+def merge_shard_results(result_file: str, num_shards: int, allow_partial: bool = False):
+    """Merge the per-shard results into `result_file` with the layout expected by `eval.py`.
+
+    A shard is complete once its results are compacted (no journal left). Incomplete shards are an error
+    unless `allow_partial=True`, in which case they are reported and whatever they have is merged.
+    """
+    incomplete = []
+    for shard_id in range(num_shards):
+        shard_file = shard_result_file(result_file, shard_id, num_shards)
+        if not os.path.exists(shard_file) or os.path.exists(journal_file_of(shard_file)):
+            incomplete.append(shard_id)
+    if incomplete:
+        message = f"Shards {incomplete} of {num_shards} have not finished: {result_file}"
+        if not allow_partial:
+            raise RuntimeError(f"{message} (merge with allow_partial=True to use their partial results)")
+        print(f"Warning: {message}; merging their partial results")
+
+    result_dict = defaultdict(dict)
+    for shard_id in range(num_shards):
+        for k, v in load_results(shard_result_file(result_file, shard_id, num_shards)).items():
+            result_dict[k].update(v)
+    return compact_results(result_file, result_dict)
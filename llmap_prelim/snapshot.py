@@ -0,0 +1,137 @@
+#    Copyright 2023 Yuan He
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from typing import Optional
+import os
+import json
+import hashlib
+import numpy as np
+from deeponto.utils import load_file, save_file
+from .files import publish_dir, tmp_dir_of
+
+# NOTE: this module must not import `deeponto.onto` because that starts the JVM
+
+SNAPSHOT_FORMAT = 1
+
+
+def file_hash(file_path: str, chunk_size: int = 1 << 20):
+    """SHA-256 of a (possibly large) file, read in chunks."""
+    sha256 = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def _to_csr(num_classes: int, edges: dict):
+    indptr = np.zeros(num_classes + 1, dtype=np.int64)
+    indices = []
+    for i in range(num_classes):
+        neighbours = edges.get(i, [])
+        indices += neighbours
+        indptr[i + 1] = indptr[i] + len(neighbours)
+    return indptr, np.array(indices, dtype=np.int32)
+
+
+class OntologySnapshot:
+    """A JVM-free snapshot of an ontology: IRI table, annotation index and asserted hierarchy.
+
+    The hierarchy is stored as CSR arrays (parents and children) which are memory-mapped on load.
+    """
+
+    def __init__(self, snapshot_dir: str):
+        self.snapshot_dir = snapshot_dir
+        with open(os.path.join(snapshot_dir, "meta.json"), "r") as f:
+            self.meta = json.load(f)
+        with open(os.path.join(snapshot_dir, "iris.txt"), "r", encoding="utf-8") as f:
+            self.iris = f.read().split("\n")
+        self.iri_to_id = {iri: i for i, iri in enumerate(self.iris)}
+        self.annotation_index = load_file(os.path.join(snapshot_dir, "annotation_index.pkl"))
+        self.parent_indptr, self.parent_indices, self.child_indptr, self.child_indices = [
+            np.load(os.path.join(snapshot_dir, f"{name}.npy"), mmap_mode="r")
+            for name in ["parent_indptr", "parent_indices", "child_indptr", "child_indices"]
+        ]
+
+    def _neighbours(self, indptr, indices, class_iri: str):
+        i = self.iri_to_id.get(class_iri)
+        if i is None:
+            return []
+        return [self.iris[j] for j in indices[indptr[i] : indptr[i + 1]]]
+
+    def get_parent_iris(self, class_iri: str):
+        return self._neighbours(self.parent_indptr, self.parent_indices, class_iri)
+
+    def get_child_iris(self, class_iri: str):
+        return self._neighbours(self.child_indptr, self.child_indices, class_iri)
+
+    @staticmethod
+    def build(ontology, annotation_index: dict, snapshot_dir: str, owl_hash: str):
+        """Write the snapshot of a loaded `deeponto.onto.Ontology` into `snapshot_dir`."""
+        parent_iris = dict()
+        for iri, owl_class in ontology.owl_classes.items():
+            parent_iris[iri] = [str(p.getIRI()) for p in ontology.get_asserted_parents(owl_class, named_only=True)]
+        return OntologySnapshot.write(snapshot_dir, annotation_index, parent_iris, owl_hash)
+
+    @staticmethod
+    def write(snapshot_dir: str, annotation_index: dict, parent_iris: dict, owl_hash: str):
+        """Write a snapshot from an annotation index and the asserted parents `{class_iri: parent_iris}`.
+
+        Like candidate files, the snapshot is built in a temporary directory and then moved into place,
+        so that workers building the same snapshot concurrently never mix their files.
+        """
+        final_dir, snapshot_dir = snapshot_dir, tmp_dir_of(snapshot_dir)
+        os.makedirs(snapshot_dir, exist_ok=True)
+        iris = list(parent_iris.keys())
+        iris += [iri for iri in annotation_index.keys() if iri not in parent_iris]
+        iri_to_id = {iri: i for i, iri in enumerate(iris)}
+
+        parents, children = dict(), dict()
+        for iri, class_parent_iris in parent_iris.items():
+            for p in class_parent_iris:
+                p = iri_to_id.get(p)
+                if p is not None:
+                    parents.setdefault(iri_to_id[iri], []).append(p)
+                    children.setdefault(p, []).append(iri_to_id[iri])
+
+        for name, edges in [("parent", parents), ("child", children)]:
+            indptr, indices = _to_csr(len(iris), edges)
+            np.save(os.path.join(snapshot_dir, f"{name}_indptr.npy"), indptr)
+            np.save(os.path.join(snapshot_dir, f"{name}_indices.npy"), indices)
+        with open(os.path.join(snapshot_dir, "iris.txt"), "w", encoding="utf-8") as f:
+            f.write("\n".join(iris))
+        save_file(annotation_index, os.path.join(snapshot_dir, "annotation_index.pkl"))
+        # the meta file is written last so that a snapshot is only valid once complete
+        with open(os.path.join(snapshot_dir, "meta.json"), "w") as f:
+            json.dump({"format": SNAPSHOT_FORMAT, "owl_sha256": owl_hash}, f)
+        publish_dir(snapshot_dir, final_dir)
+
+        return OntologySnapshot(final_dir)
+
+
+def snapshot_dir_of(onto_file: str):
+    return f"{onto_file}.snapshot"
+
+
+def load_snapshot(onto_file: str, owl_hash: Optional[str] = None):
+    """Load the snapshot of an OWL file if it exists and matches the file's current hash."""
+    snapshot_dir = snapshot_dir_of(onto_file)
+    meta_file = os.path.join(snapshot_dir, "meta.json")
+    if not os.path.exists(meta_file):
+        return None
+    with open(meta_file, "r") as f:
+        meta = json.load(f)
+    owl_hash = owl_hash or file_hash(onto_file)
+    if meta.get("format") != SNAPSHOT_FORMAT or meta.get("owl_sha256") != owl_hash:
+        return None
+    return OntologySnapshot(snapshot_dir)
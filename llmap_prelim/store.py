@@ -0,0 +1,174 @@
+#    Copyright 2023 Yuan He
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from typing import Optional
+from array import array
+from collections import defaultdict
+import os
+import json
+import numpy as np
+from .journal import load_results, journal_file_of
+
+STORE_FORMAT = 1
+
+# answer codes; BERTMap results have no textual answer
+ANSWER_NO, ANSWER_YES, ANSWER_NONE = 0, 1, -1
+
+COLUMNS = {
+    "src": np.int32,
+    "ref": np.int32,
+    "cand": np.int32,
+    "answer": np.int8,
+    "score": np.float64,
+    "score_lt": np.float64,
+    "group_indptr": np.int64,
+}
+
+
+def is_positive_answer(answer: str):
+    """Whether an LLM answer says "Yes"."""
+    return "Yes" in answer or "yes" in answer or "are identical" in answer
+
+
+class ResultStore:
+    """Array-backed results: one row per `(src_ref, tgt_ref, tgt_cand)` with IRIs interned into `iris`.
+
+    Rows of the same `(src_ref, tgt_ref)` group are contiguous and in insertion order; `src` and `ref`
+    hold one id per group and `group_indptr` the row range of each group (CSR layout). For BERTMap,
+    `score` is the BERTMap score and `score_lt` the BERTMapLt score; for LLMs, `answer` holds the
+    answer code and `score_lt` is unused.
+    """
+
+    def __init__(self, iris: list, columns: dict, bertmap: bool):
+        self.iris = iris
+        self.bertmap = bertmap
+        for name in COLUMNS:
+            setattr(self, name, columns[name])
+
+    def __len__(self):
+        return len(self.cand)
+
+    @property
+    def num_groups(self):
+        return len(self.group_indptr) - 1
+
+    def group_ids(self):
+        """The `(src_ref, tgt_ref)` group of every row."""
+        return np.repeat(np.arange(self.num_groups), np.diff(self.group_indptr))
+
+    @staticmethod
+    def from_results(result_dict: dict):
+        """Intern a result dict `{(src_ref, tgt_ref): {tgt_cand: value}}` into arrays.
+
+        Only the `(answer, score)` of a value is stored: the local and remote answers that escalation runs
+        keep as a third element are dropped, so build stores of those from `eval.escalation_view`.
+        """
+        iri_to_id = dict()
+
+        def intern(iri):
+            return iri_to_id.setdefault(iri, len(iri_to_id))
+
+        src, ref, cand, answer = array("i"), array("i"), array("i"), array("b")
+        score, score_lt, group_indptr = array("d"), array("d"), array("q", [0])
+        bertmap = None
+        for (src_ref, tgt_ref), v in result_dict.items():
+            src.append(intern(src_ref))
+            ref.append(intern(tgt_ref))
+            for tgt_cand, value in v.items():
+                if bertmap is None:
+                    bertmap = not isinstance(value[0], str)
+                cand.append(intern(tgt_cand))
+                if bertmap:
+                    answer.append(ANSWER_NONE)
+                    score.append(value[0])
+                    score_lt.append(value[1])
+                else:
+                    answer.append(ANSWER_YES if is_positive_answer(value[0]) else ANSWER_NO)
+                    score.append(value[1])
+                    score_lt.append(np.nan)
+            group_indptr.append(len(cand))
+
+        columns = {
+            name: np.frombuffer(values, dtype=COLUMNS[name]) if len(values) else np.zeros(0, dtype=COLUMNS[name])
+            for name, values in zip(COLUMNS, [src, ref, cand, answer, score, score_lt, group_indptr])
+        }
+        return ResultStore(list(iri_to_id.keys()), columns, bool(bertmap))
+
+    def to_results(self):
+        """Export back into the result dict layout (e.g., for `unpack_results_for_llm`)."""
+        result_dict = defaultdict(dict)
+        for g in range(self.num_groups):
+            preds = result_dict[self.iris[self.src[g]], self.iris[self.ref[g]]]
+            for i in range(self.group_indptr[g], self.group_indptr[g + 1]):
+                if self.bertmap:
+                    preds[self.iris[self.cand[i]]] = (float(self.score[i]), float(self.score_lt[i]))
+                else:
+                    answer = "Yes" if self.answer[i] == ANSWER_YES else "No"
+                    preds[self.iris[self.cand[i]]] = (answer, float(self.score[i]))
+        return result_dict
+
+    def save(self, store_dir: str):
+        os.makedirs(store_dir, exist_ok=True)
+        if os.path.exists(os.path.join(store_dir, "meta.json")):
+            os.remove(os.path.join(store_dir, "meta.json"))
+        for name in COLUMNS:
+            np.save(os.path.join(store_dir, f"{name}.npy"), getattr(self, name))
+        with open(os.path.join(store_dir, "iris.txt"), "w", encoding="utf-8") as f:
+            f.write("\n".join(self.iris))
+        # the meta file is written last so that an interrupted save is never considered valid
+        with open(os.path.join(store_dir, "meta.json"), "w") as f:
+            json.dump({"format": STORE_FORMAT, "bertmap": self.bertmap, "num_rows": len(self)}, f)
+
+    @staticmethod
+    def load(store_dir: str, mmap: bool = True):
+        """Load a saved store; the columns are memory-mapped unless `mmap=False`."""
+        with open(os.path.join(store_dir, "meta.json"), "r") as f:
+            meta = json.load(f)
+        assert meta["format"] == STORE_FORMAT, f"unsupported result store format: {meta['format']}"
+        with open(os.path.join(store_dir, "iris.txt"), "r", encoding="utf-8") as f:
+            iris = f.read().split("\n")
+        columns = {
+            name: np.load(os.path.join(store_dir, f"{name}.npy"), mmap_mode="r" if mmap else None) for name in COLUMNS
+        }
+        return ResultStore(iris, columns, meta["bertmap"])
+
+    def decisions(self, threshold: float = 0.0, score_column: str = "score"):
+        """Boolean mask of the rows predicted as mappings ("Yes" and/or score at least `threshold`)."""
+        scores = getattr(self, score_column)
+        if self.bertmap:
+            return scores >= threshold
+        return (self.answer == ANSWER_YES) & (scores >= threshold)
+
+    def rank(self, score_column: str = "score"):
+        """Row order that sorts each group by descending score (stable, like `sort_entity_mappings_by_score`)."""
+        return np.lexsort((-getattr(self, score_column), self.group_ids()))
+
+
+def store_dir_of(result_file: str):
+    return f"{result_file}.store"
+
+
+def load_result_store(result_file: str, store_dir: Optional[str] = None):
+    """Load the store of a result file, (re)building it when it is missing or older than the results.
+
+    The results include the journal of an unfinished run, so appending to it also invalidates the store.
+    """
+    store_dir = store_dir or store_dir_of(result_file)
+    meta_file = os.path.join(store_dir, "meta.json")
+    result_files = [f for f in [result_file, journal_file_of(result_file)] if os.path.exists(f)]
+    if os.path.exists(meta_file) and all(os.path.getmtime(meta_file) >= os.path.getmtime(f) for f in result_files):
+        return ResultStore.load(store_dir)
+    store = ResultStore.from_results(load_results(result_file))
+    store.save(store_dir)
+    return store
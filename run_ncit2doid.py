@@ -4,47 +4,224 @@ import sys
 main_dir = os.getcwd().split("LLMap")[0] + "LLMap"
 sys.path.append(main_dir)
 
-from deeponto.align.bertmap import BERTMapPipeline
-from deeponto.utils import read_table
-from llmap_prelim.processing import load_ontos
-from llmap_prelim.models import LMPredictor
+from llmap_prelim.processing import load_ontos, load_hierarchy_index
+from llmap_prelim.models import LMPredictor, EscalatingPredictor
+from llmap_prelim.cache import PromptCache
 from llmap_prelim import run_experiments
+from llmap_prelim.sharding import run_shard, merge_shard_results
+from llmap_prelim import cascade
 import click
 
 @click.command()
 @click.option("-m", "--model_type", type=str)
 @click.option("-k", "--api_key", type=str, default=None)
 @click.option("-s", "--with_structural_context", type=bool, default=False)
-def run(model_type, api_key, with_structural_context):
+@click.option("-b", "--batch_size", type=int, default=16)
+@click.option("-c", "--max_in_flight", type=int, default=8)
+@click.option("--requests_per_minute", type=int, default=3500)
+@click.option("--tokens_per_minute", type=int, default=90000)
+@click.option("--cache_file", type=str, default=None)
+@click.option("--num_shards", type=int, default=1)
+@click.option("--shard_id", type=int, default=0)
+@click.option("--merge_shards", is_flag=True, default=False)
+@click.option("--allow_partial", is_flag=True, default=False, help="merge shards that have not finished")
+@click.option("--cascade_top_k", type=int, default=None)
+@click.option("--cascade_threshold", type=float, default=None)
+@click.option("--cascade_report", is_flag=True, default=False)
+@click.option("--listwise", is_flag=True, default=False)
+@click.option("--listwise_chunk_size", type=int, default=20)
+@click.option(
+    "--t5_model_name",
+    type=str,
+    default=None,
+    help="defaults to google/flan-t5-xxl for flan-t5 and google/flan-t5-large for flan-t5-cpu",
+)
+@click.option("--quantize/--no_quantize", default=True)
+@click.option("--num_threads", type=int, default=None)
+@click.option("--metrics_file", type=str, default=None)
+@click.option("--prompt_token_budget", type=int, default=None)
+@click.option("--generate_top_k", type=int, default=None)
+@click.option("--generate_chunk_size", type=int, default=256, help="source classes scored per sparse product")
+@click.option("--src_onto_file", type=str, default=None, help="a new release of the source ontology")
+@click.option("--tgt_onto_file", type=str, default=None, help="a new release of the target ontology")
+@click.option("--prev_result_file", type=str, default=None)
+@click.option("--prev_src_onto_file", type=str, default=None)
+@click.option("--prev_tgt_onto_file", type=str, default=None)
+@click.option("--pipeline_prefetch", type=int, default=0)
+@click.option("--escalate_to_gpt", is_flag=True, default=False)
+@click.option("--uncertainty_band", type=(float, float), default=(-0.8, 0.8))
+def run(
+    model_type,
+    api_key,
+    with_structural_context,
+    batch_size,
+    max_in_flight,
+    requests_per_minute,
+    tokens_per_minute,
+    cache_file,
+    num_shards,
+    shard_id,
+    merge_shards,
+    allow_partial,
+    cascade_top_k,
+    cascade_threshold,
+    cascade_report,
+    listwise,
+    listwise_chunk_size,
+    t5_model_name,
+    quantize,
+    num_threads,
+    metrics_file,
+    prompt_token_budget,
+    generate_top_k,
+    generate_chunk_size,
+    src_onto_file,
+    tgt_onto_file,
+    prev_result_file,
+    prev_src_onto_file,
+    prev_tgt_onto_file,
+    pipeline_prefetch,
+    escalate_to_gpt,
+    uncertainty_band,
+):
 
-    src_onto_file = f"{main_dir}/data/ncit2doid/ncit.owl"
-    tgt_onto_file = f"{main_dir}/data/ncit2doid/doid.owl"
+    src_onto_file = src_onto_file or f"{main_dir}/data/ncit2doid/ncit.owl"
+    tgt_onto_file = tgt_onto_file or f"{main_dir}/data/ncit2doid/doid.owl"
     test_cand_file = f"{main_dir}/data/ncit2doid/test_cands.tsv"
     result_file = f"./{model_type}_ncit2doid_results.pkl"
     if with_structural_context:
         result_file = f"./{model_type}_ncit2doid_results_struct.pkl"
+    if listwise:
+        result_file = result_file.replace("_results", "_results_listwise")
+    if escalate_to_gpt:
+        assert model_type in ["flan-t5", "flan-t5-cpu"] and not listwise, "escalation goes from flan-t5 to gpt"
+        result_file = result_file.replace("_results", "_escalated_results")
+    if generate_top_k:
+        # all source classes against candidates retrieved from the full target ontology
+        test_cand_file = f"{main_dir}/data/ncit2doid/full_cands_top{generate_top_k}"
+        result_file = result_file.replace("_results", "_full_results")
+
+    if merge_shards:
+        merge_shard_results(result_file, num_shards, allow_partial)
+        return
     
-    src_onto, tgt_onto, src_annotation_index, tgt_annotation_index, config = load_ontos(src_onto_file, tgt_onto_file)
-    test_cands = read_table(test_cand_file)
+    src_onto, tgt_onto, src_annotation_index, tgt_annotation_index, config = load_ontos(
+        src_onto_file, tgt_onto_file, use_snapshot=model_type != "bertmap"
+    )
+
+    if generate_top_k and not os.path.exists(f"{test_cand_file}/meta.json"):
+        # the candidates are only moved into place once complete, so an interrupted generation is redone
+        from llmap_prelim.candidates import read_reference_pairs, write_candidates_binary
+        from llmap_prelim.generation import generate_candidates
+
+        reference = dict(read_reference_pairs(f"{main_dir}/data/ncit2doid/refs/full_refs.tsv"))
+        skipped = []
+        rows = generate_candidates(
+            src_annotation_index,
+            tgt_annotation_index,
+            generate_top_k,
+            reference,
+            chunk_size=generate_chunk_size,
+            skipped=skipped,
+        )
+        write_candidates_binary(rows, test_cand_file)
+        if skipped:
+            print(f"{len(skipped)} source classes have no lexical candidates and are left out of {test_cand_file}")
+
+    if cascade_report:
+        # recall-vs-calls trade-off of the lexical pre-filter for tuning --cascade_top_k
+        for row in cascade.cascade_report(test_cand_file, src_annotation_index, tgt_annotation_index):
+            print(row)
+        return
+
+    src_hierarchy_index, tgt_hierarchy_index = None, None
+    if with_structural_context:
+        src_hierarchy_index = load_hierarchy_index(src_onto, src_annotation_index, src_onto_file)
+        tgt_hierarchy_index = load_hierarchy_index(tgt_onto, tgt_annotation_index, tgt_onto_file)
     
+    if prev_result_file:
+        # incremental re-alignment: only the pairs whose prompts changed since the previous release are scored
+        from llmap_prelim.incremental import VersionDiff, carry_forward_results
+
+        # the new release must be a different file (see --src_onto_file/--tgt_onto_file) from the previous one
+        assert prev_src_onto_file != src_onto_file and prev_tgt_onto_file != tgt_onto_file
+        prev_src_onto, prev_tgt_onto, prev_src_annotation_index, prev_tgt_annotation_index, _ = load_ontos(
+            prev_src_onto_file or src_onto_file, prev_tgt_onto_file or tgt_onto_file, use_snapshot=True
+        )
+        src_diff, tgt_diff = None, None
+        if prev_src_onto_file:
+            src_diff = VersionDiff(
+                prev_src_onto, prev_src_annotation_index, src_onto, src_annotation_index,
+                with_structural_context, new_hierarchy_index=src_hierarchy_index,
+            )
+        if prev_tgt_onto_file:
+            tgt_diff = VersionDiff(
+                prev_tgt_onto, prev_tgt_annotation_index, tgt_onto, tgt_annotation_index,
+                with_structural_context, new_hierarchy_index=tgt_hierarchy_index,
+            )
+        print(carry_forward_results(prev_result_file, result_file, test_cand_file, src_diff, tgt_diff))
+
     bertmap = None
     if model_type == "bertmap":
+        # bertmap needs the full ontologies and hence the JVM
+        from deeponto.align.bertmap import BERTMapPipeline
+
         config.global_matching.enabled = False
         config.output_path = "ncit2doid.us/"
         bertmap = BERTMapPipeline(src_onto, tgt_onto, config)
 
-    predictor = LMPredictor(model_type, api_key, bertmap)
+    predictor = LMPredictor(
+        model_type,
+        api_key,
+        bertmap,
+        max_in_flight=max_in_flight,
+        requests_per_minute=requests_per_minute,
+        tokens_per_minute=tokens_per_minute,
+        cache=PromptCache(cache_file) if cache_file else None,
+        t5_model_name=t5_model_name,
+        quantize=quantize,
+        num_threads=num_threads,
+    )
+    if escalate_to_gpt:
+        # flan-t5 scores every pair; only those with a score inside the uncertainty band go to gpt
+        remote = LMPredictor(
+            "gpt",
+            api_key,
+            max_in_flight=max_in_flight,
+            requests_per_minute=requests_per_minute,
+            tokens_per_minute=tokens_per_minute,
+            cache=predictor.cache,
+        )
+        predictor = EscalatingPredictor(predictor, remote, uncertainty_band)
 
-    run_experiments(
-        src_onto,
-        tgt_onto,
-        src_annotation_index,
-        tgt_annotation_index,
-        predictor,
-        test_cands,
-        result_file,
+    experiment_kwargs = dict(
+        src_onto=src_onto,
+        tgt_onto=tgt_onto,
+        src_annotation_index=src_annotation_index,
+        tgt_annotation_index=tgt_annotation_index,
+        predictor=predictor,
         with_structural_context=with_structural_context,
+        batch_size=batch_size,
+        src_hierarchy_index=src_hierarchy_index,
+        tgt_hierarchy_index=tgt_hierarchy_index,
+        cascade_top_k=cascade_top_k,
+        cascade_threshold=cascade_threshold,
+        listwise=listwise,
+        listwise_chunk_size=listwise_chunk_size,
+        metrics_file=metrics_file,
+        prompt_token_budget=prompt_token_budget,
+        pipeline_prefetch=pipeline_prefetch,
     )
+    if num_shards > 1:
+        # one worker per shard; merge afterwards with --merge_shards
+        summary = run_shard(test_cand_file, result_file, shard_id, num_shards, **experiment_kwargs)
+    else:
+        summary = run_experiments(test_cands=test_cand_file, result_file=result_file, **experiment_kwargs)
+
+    # latency percentiles, throughput, tokens, retries, cache hits and estimated cost
+    print(summary)
+    if predictor.cache is not None:
+        predictor.cache.close()
 
 
 if __name__ == "__main__":
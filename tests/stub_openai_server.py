@@ -0,0 +1,128 @@
+#    Copyright 2023 Yuan He
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""A local stand-in for the OpenAI chat completions endpoint with simulated latency and rate limiting.
+
+Point `LMPredictor("gpt", openai_api_base=...)` at `http://127.0.0.1:<port>/v1` to exercise the
+dispatcher (concurrency, rate limits, retries) without network access or costs:
+
+    python tests/stub_openai_server.py --port 8000 --latency 0.2 --rate_limit_every 5
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from contextlib import contextmanager
+import json
+import threading
+import time
+import click
+
+
+class StubOpenAIServer(ThreadingHTTPServer):
+    """Answer "Yes" to prompts containing `yes_marker` and "No" otherwise, after `latency` seconds.
+
+    Every `rate_limit_every`-th request (if set) is rejected with a 429 instead; `max_in_flight` records
+    the highest number of requests served concurrently.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, port: int = 0, latency: float = 0.0, rate_limit_every: int = 0, yes_marker: str = "yes"):
+        super().__init__(("127.0.0.1", port), StubOpenAIHandler)
+        self.latency = latency
+        self.rate_limit_every = rate_limit_every
+        self.yes_marker = yes_marker
+        self.lock = threading.Lock()
+        self.num_requests, self.num_rate_limited = 0, 0
+        self.in_flight, self.max_in_flight = 0, 0
+
+    @property
+    def api_base(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/v1"
+
+
+class StubOpenAIHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status: int, body: dict):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        server = self.server
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        with server.lock:
+            server.num_requests += 1
+            rate_limited = server.rate_limit_every and server.num_requests % server.rate_limit_every == 0
+            server.num_rate_limited += bool(rate_limited)
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+        try:
+            if not self.path.endswith("/chat/completions"):
+                self._reply(404, {"error": {"message": f"unknown path {self.path}", "type": "invalid_request_error"}})
+                return
+            if rate_limited:
+                self._reply(429, {"error": {"message": "Rate limit reached (stub)", "type": "requests"}})
+                return
+            time.sleep(server.latency)
+            prompt = request["messages"][0]["content"]
+            answer = "Yes" if server.yes_marker in prompt else "No"
+            self._reply(
+                200,
+                {
+                    "id": f"chatcmpl-stub{server.num_requests}",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": request["model"],
+                    "choices": [
+                        {"index": 0, "message": {"role": "assistant", "content": answer}, "finish_reason": "stop"}
+                    ],
+                    "usage": {"prompt_tokens": len(prompt) // 4 + 1, "completion_tokens": 1},
+                },
+            )
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+
+@contextmanager
+def serve(**kwargs):
+    """Run a `StubOpenAIServer` (on a free port by default) in a background thread."""
+    server = StubOpenAIServer(**kwargs)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+
+@click.command()
+@click.option("--port", type=int, default=8000)
+@click.option("--latency", type=float, default=0.2)
+@click.option("--rate_limit_every", type=int, default=0)
+def run(port, latency, rate_limit_every):
+    server = StubOpenAIServer(port, latency, rate_limit_every)
+    print(f"Serving a stub of the OpenAI API at {server.api_base}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,70 @@
+#    Copyright 2023 Yuan He
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import openai
+import pytest
+from llmap_prelim.dispatch import RetriesExceededError, call_with_retries
+from llmap_prelim.models import LMPredictor
+from stub_openai_server import serve
+
+
+def test_dispatcher_retries_rate_limited_requests(monkeypatch):
+    monkeypatch.setattr(openai, "api_base", openai.api_base)
+    prompts = [(i, f"prompt {i}: {'yes' if i % 3 == 0 else 'no'}") for i in range(16)]
+    with serve(latency=0.1, rate_limit_every=5) as server:
+        predictor = LMPredictor(
+            "gpt", openai_key="stub", openai_api_base=server.api_base, max_in_flight=4, requests_per_minute=None
+        )
+        results = {key: (result, seconds) for key, result, seconds in predictor.predict_stream(prompts)}
+
+    assert sorted(results) == [i for i, _ in prompts]
+    assert all(results[i][0][0] == ("Yes" if i % 3 == 0 else "No") for i, _ in prompts)
+    # each result comes with the duration of its own request, which includes the simulated latency
+    assert all(0.1 <= seconds < 1.0 for _, seconds in results.values())
+    # every rejected request was retried, and the concurrency never exceeded `max_in_flight`
+    assert server.num_rate_limited > 0
+    assert predictor.stats["retries"] == server.num_rate_limited
+    assert predictor.stats["requests"] == len(prompts)
+    assert 1 < server.max_in_flight <= 4
+
+
+def test_exhausted_retries_raise_from_the_last_error():
+    errors = []
+
+    def rate_limited():
+        errors.append(openai.error.RateLimitError(f"attempt {len(errors)}"))
+        raise errors[-1]
+
+    with pytest.raises(RetriesExceededError) as excinfo:
+        call_with_retries(rate_limited, max_retries=2, backoff_in_seconds=0.0)
+    assert len(errors) == 3
+    assert excinfo.value.__cause__ is errors[-1]
+
+
+def test_server_errors_are_retried_and_client_errors_are_not():
+    attempts = []
+
+    def flaky(http_status):
+        attempts.append(http_status)
+        if len(attempts) == 1:
+            raise openai.error.APIError("server error", http_status=http_status)
+        return "ok"
+
+    assert call_with_retries(flaky, 502, backoff_in_seconds=0.0) == "ok"
+    assert attempts == [502, 502]
+
+    attempts.clear()
+    with pytest.raises(openai.error.APIError):
+        call_with_retries(flaky, 400, backoff_in_seconds=0.0)
+    assert attempts == [400]
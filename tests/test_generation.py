@@ -0,0 +1,71 @@
+#    Copyright 2023 Yuan He
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import random
+import numpy as np
+from llmap_prelim.generation import LexicalIndex, generate_candidates
+
+WORDS = ["heart", "lung", "cancer", "carcinoma", "renal", "cell", "acute", "chronic", "disease", "tumor", "liver"]
+
+
+def clustered_index(prefix: str, num_classes: int, rng: random.Random):
+    # few words and several labels per class, so that many classes share most of their n-grams
+    return {
+        f"{prefix}{i}": {" ".join(rng.sample(WORDS, rng.randint(1, 4))) for _ in range(rng.randint(1, 4))}
+        for i in range(num_classes)
+    }
+
+
+def brute_force_class_scores(index: LexicalIndex, labels: list):
+    label_scores = index.transform(labels).dot(index.matrix_t).toarray().max(axis=0)
+    class_scores = np.zeros(len(index.iris))
+    np.maximum.at(class_scores, index.label_class, label_scores)
+    return class_scores
+
+
+def test_top_k_matches_brute_force():
+    rng = random.Random(0)
+    tgt_annotation_index = clustered_index("t", 500, rng)
+    src_annotation_index = clustered_index("s", 50, rng)
+    index = LexicalIndex(tgt_annotation_index)
+    src_labels = [list(labels) for labels in src_annotation_index.values()]
+    for k in [1, 10, 50]:
+        for labels, (tgt_ids, scores) in zip(src_labels, index.top_k(src_labels, k)):
+            expected = np.sort(brute_force_class_scores(index, labels))[::-1][:k]
+            assert np.allclose(scores, expected, atol=1e-5)
+            assert np.allclose(brute_force_class_scores(index, labels)[tgt_ids], scores, atol=1e-5)
+
+
+def test_classes_matched_by_any_source_label_are_kept():
+    # class "b" only matches the third source label, which the label pairs of "a" outnumber
+    index = LexicalIndex({"a": {"acute renal failure", "renal failure"}, "b": {"liver"}})
+    (tgt_ids, scores), = index.top_k([["acute renal failure", "renal failure acute", "liver disease"]], 2)
+    assert [index.iris[j] for j in tgt_ids] == ["a", "b"]
+    assert scores[1] > 0
+
+
+def test_source_classes_without_candidates_are_reported():
+    tgt_annotation_index = {f"t{i}": {f"cancer of organ {i}"} for i in range(60)}
+    tgt_annotation_index["t_cancer"] = {"cancer"}
+    src_annotation_index = {"s_cancer": {"cancer"}, "s_unrelated": {"xyz"}, "s_unlabelled": set()}
+
+    skipped = []
+    rows = list(generate_candidates(src_annotation_index, tgt_annotation_index, top_k=1, skipped=skipped))
+    assert rows == [("s_cancer", "UnMatched", ["t_cancer"])]
+    assert sorted(skipped) == ["s_unlabelled", "s_unrelated"]
+
+    # with common n-grams dropped, "cancer" shares nothing with the targets any more
+    skipped = []
+    rows = list(generate_candidates(src_annotation_index, tgt_annotation_index, top_k=1, max_df=0.02, skipped=skipped))
+    assert rows == [] and sorted(skipped) == ["s_cancer", "s_unlabelled", "s_unrelated"]
@@ -0,0 +1,52 @@
+#    Copyright 2023 Yuan He
+
+#    Licensed under the Apache License, Version 2.0 (the "License");
+#    you may not use this file except in compliance with the License.
+#    You may obtain a copy of the License at
+
+#        http://www.apache.org/licenses/LICENSE-2.0
+
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS,
+#    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from llmap_prelim.incremental import VersionDiff
+from llmap_prelim.processing import load_hierarchy_index
+from llmap_prelim.snapshot import OntologySnapshot, file_hash
+
+ANNOTATION_INDEX = {"a": {"alpha"}, "b": {"beta"}, "c": {"gamma"}}
+
+
+def write_release(tmp_path, owl_file, content, parent_iris, name):
+    # a release replaces the OWL file at the same path; its snapshot carries the new hash
+    owl_file.write_text(content)
+    return OntologySnapshot.write(str(tmp_path / name), ANNOTATION_INDEX, parent_iris, file_hash(str(owl_file)))
+
+
+def test_changed_parents_are_detected_across_releases(tmp_path):
+    owl_file = tmp_path / "onto.owl"
+    old_onto = write_release(tmp_path, owl_file, "v1", {"a": [], "b": ["a"], "c": ["a"]}, "v1.snapshot")
+    old_hierarchy_index = load_hierarchy_index(old_onto, ANNOTATION_INDEX, str(owl_file))
+
+    # "b" moves from under "a" to under "c"; no label changes
+    new_onto = write_release(tmp_path, owl_file, "v2", {"a": [], "b": ["c"], "c": ["a"]}, "v2.snapshot")
+    new_hierarchy_index = load_hierarchy_index(new_onto, ANNOTATION_INDEX, str(owl_file))
+    assert new_hierarchy_index["b"][0] == ["gamma"]
+
+    diff = VersionDiff(
+        old_onto,
+        ANNOTATION_INDEX,
+        new_onto,
+        ANNOTATION_INDEX,
+        with_structural_context=True,
+        old_hierarchy_index=old_hierarchy_index,
+        new_hierarchy_index=new_hierarchy_index,
+    )
+    assert diff.changed("b")
+    # "a" and "c" gain or lose "b" as a child
+    assert diff.changed("a") and diff.changed("c")
+
+    labels_only = VersionDiff(old_onto, ANNOTATION_INDEX, new_onto, ANNOTATION_INDEX, with_structural_context=False)
+    assert not labels_only.changed("b")